@@ -3,9 +3,10 @@ from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, Call
 from telegram.error import BadRequest, Forbidden
 import logging
 
-from config import ADMIN_IDS, MESSAGES, USERS_FILE
+from config import ADMIN_IDS, MESSAGES
 from utils.json_handler import JsonHandler
-from utils.subscription_manager import SubscriptionManager
+from utils.reconciler import MembershipReconciler
+from utils.subscription_manager import RemovalRetryQueue, SubscriptionManager
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -35,7 +36,7 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Non-admin user {update.effective_user.id} attempted to use admin command")
         return ConversationHandler.END
 
-    users = JsonHandler.load_data(USERS_FILE)
+    users = await JsonHandler.aget_all_users()
     if not users:
         response = "Пользователи не найдены в базе данных"
         await update.message.reply_text(response)
@@ -44,13 +45,63 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     response = "Зарегистрированные пользователи:\n\n"
     for user_id, user_data in users.items():
-        status = "Активна" if SubscriptionManager.is_subscription_active(int(user_id)) else "Неактивна"
+        status = "Активна" if await SubscriptionManager.ais_subscription_active(int(user_id)) else "Неактивна"
         response += f"ID: {user_id}\nПользователь: @{user_data.get('username', 'N/A')}\nСтатус: {status}\n\n"
 
     await update.message.reply_text(response)
     logger.info(f"Admin {update.effective_user.id} viewed user list:\n{response}")
     return ConversationHandler.END
 
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reconcile group membership with subscriptions now and report the drift found"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text(MESSAGES["not_admin"])
+        logger.info(f"Non-admin user {update.effective_user.id} attempted to use admin command")
+        return ConversationHandler.END
+
+    await update.message.reply_text("Сверка участников групп запущена...")
+    metrics = await MembershipReconciler.reconcile()
+    response = (
+        "Сверка участников групп завершена:\n"
+        f"Участников отслеживается: {metrics['tracked_members']}\n"
+        f"Без подписки: {metrics['unentitled_members']}\n"
+        f"Удалено: {metrics['removed']}\n"
+        f"Не удалось удалить: {metrics['removal_failed']}\n"
+        f"Подписчиков в бане: {metrics['banned_subscribers']}\n"
+        f"Отправлены новые ссылки: {metrics['reinvited']}"
+    )
+    await update.message.reply_text(response)
+    logger.info(f"Admin {update.effective_user.id} ran membership reconciliation:\n{response}")
+    return ConversationHandler.END
+
+async def failed_removals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show group removals that are being retried or were given up on.
+
+    /failed_removals retry re-queues the ones that were given up on."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text(MESSAGES["not_admin"])
+        logger.info(f"Non-admin user {update.effective_user.id} attempted to use admin command")
+        return ConversationHandler.END
+
+    if context.args and context.args[0] == "retry":
+        count = await RemovalRetryQueue.requeue_dead_letters()
+        response = f"Повторно поставлено в очередь удалений: {count}"
+        await update.message.reply_text(response)
+        logger.info(f"Admin {update.effective_user.id} re-queued {count} failed removals")
+        return ConversationHandler.END
+
+    dead = RemovalRetryQueue.dead_letters()
+    response = f"Удалений в очереди на повтор: {len(RemovalRetryQueue.pending())}\n"
+    response += f"Неудавшихся удалений: {len(dead)}\n"
+    for entry in dead[:20]:
+        response += f"\nПользователь {entry['user_id']}, группа {entry['group_id']}, попыток: {entry['attempts']}\n"
+        response += f"Ошибка: {entry['last_error']}\n"
+    if dead:
+        response += "\nИспользуйте /failed_removals retry чтобы повторить их."
+    await update.message.reply_text(response)
+    logger.info(f"Admin {update.effective_user.id} viewed failed removals:\n{response}")
+    return ConversationHandler.END
+
 async def manage_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start user management process"""
     if update.effective_user.id not in ADMIN_IDS:
@@ -60,7 +111,7 @@ async def manage_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = int(update.message.text.split()[1])
-        user_data = JsonHandler.get_user(user_id)
+        user_data = await JsonHandler.aget_user(user_id)
         if not user_data:
             await update.message.reply_text(MESSAGES["user_not_found"])
             logger.info(f"Admin {update.effective_user.id} attempted to manage non-existent user {user_id}")
@@ -77,7 +128,8 @@ async def manage_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         response = f"Информация о пользователе:\nID: {user_id}\nПользователь: @{user_data.get('username', 'N/A')}\n"
         response += f"Тариф: {user_data.get('subscription_type', 'Нет')}\n"
-        response += f"Статус: {'Активна' if SubscriptionManager.is_subscription_active(user_id) else 'Неактивна'}"
+        is_active = await SubscriptionManager.ais_subscription_active(user_id)
+        response += f"Статус: {'Активна' if is_active else 'Неактивна'}"
         
         await update.message.reply_text(response, reply_markup=reply_markup)
         logger.info(f"Admin {update.effective_user.id} viewing user details:\n{response}")
@@ -111,7 +163,7 @@ async def handle_user_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
             logger.info(f"Admin {update.effective_user.id} expired subscription for user {user_id}")
             
             # Show updated user status
-            user_data = JsonHandler.get_user(user_id)
+            user_data = await JsonHandler.aget_user(user_id)
             status_response = f"Обновленный статус пользователя:\nID: {user_id}\nПользователь: @{user_data.get('username', 'N/A')}\n"
             status_response += f"Тариф: {user_data.get('subscription_type', 'Нет')}\n"
             status_response += f"Статус: Неактивна"
@@ -0,0 +1,59 @@
+from telegram import ChatMember, ChatMemberBanned, ChatMemberRestricted, Update
+from telegram.ext import ContextTypes, ChatMemberHandler
+import logging
+
+import config
+from config import ADMIN_IDS, GROUP_IDS
+from utils.json_handler import JsonHandler
+from utils.subscription_manager import SubscriptionManager
+
+# Remove users who join a managed group without a subscription that includes it
+KICK_UNENTITLED_MEMBERS = getattr(config, "KICK_UNENTITLED_MEMBERS", True)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+def is_present(member: ChatMember) -> bool:
+    """Check if a chat member status means the user is in the group"""
+    if isinstance(member, ChatMemberRestricted):
+        return member.is_member
+    return member.status in (ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record membership changes in the managed groups and remove unentitled joiners"""
+    change = update.chat_member
+    group_id = change.chat.id
+    if group_id not in GROUP_IDS:
+        return
+
+    member = change.new_chat_member
+    user_id = member.user.id
+    present = is_present(member)
+    membership = {
+        "status": member.status,
+        "is_member": present,
+        "is_bot": member.user.is_bot,
+        "updated_at": int(change.date.timestamp())
+    }
+    if isinstance(member, ChatMemberBanned):
+        # Telegram sends no update when a timed ban ends, so keep when it does; 0 means never
+        membership["until_date"] = int(member.until_date.timestamp()) if member.until_date else 0
+    await JsonHandler.asave_membership(group_id, user_id, membership)
+    logger.info(f"User {user_id} is now {member.status} in group {group_id}")
+
+    if not KICK_UNENTITLED_MEMBERS or not present or is_present(change.old_chat_member):
+        return
+    # Only ordinary members who just joined are checked
+    if member.status != ChatMember.MEMBER and not isinstance(member, ChatMemberRestricted):
+        return
+    if member.user.is_bot or user_id in ADMIN_IDS:
+        return
+    if await SubscriptionManager.ahas_group_access(user_id, group_id):
+        return
+
+    logger.warning(f"User {user_id} joined group {group_id} without a subscription, removing")
+    result = await SubscriptionManager.remove_from_group(user_id, group_id)
+    if not result.ok:
+        logger.error(f"Could not remove unentitled user {user_id} from group {group_id}: {result.error}")
+
+chat_member_handler = ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER)
@@ -1,11 +1,16 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler
+from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler, ChatJoinRequestHandler
 from telegram.error import BadRequest, Forbidden
 import logging
 
+import config
 from config import MESSAGES, SUBSCRIPTION_TYPES
+from utils import robokassa
 from utils.json_handler import JsonHandler
 from utils.subscription_manager import SubscriptionManager
+from utils.activation import agrant_subscription
+from utils.idempotency import IdempotencyStore
+from utils.rate_limiter import PRIORITY_PAYMENT, priority
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -13,10 +18,16 @@ logger = logging.getLogger(__name__)
 # Conversation states
 SELECTING_SUBSCRIPTION = 1
 
+# Callback updates already handled, by update ID and by the button tapped, so
+# redelivered updates and repeated taps on one button do nothing
+CALLBACK_IDEMPOTENCY_TTL = getattr(config, "CALLBACK_IDEMPOTENCY_TTL", 10 * 60)
+handled_updates = IdempotencyStore(CALLBACK_IDEMPOTENCY_TTL)
+handled_taps = IdempotencyStore(CALLBACK_IDEMPOTENCY_TTL)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user_id = update.effective_user.id
-    user_data = JsonHandler.get_user(user_id)
+    user_data = await JsonHandler.aget_user(user_id)
     
     if not user_data:
         # Create new user
@@ -26,7 +37,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "last_name": update.effective_user.last_name,
             "created_at": int(update.message.date.timestamp())
         }
-        JsonHandler.save_user(user_id, user_data)
+        await JsonHandler.asave_user(user_id, user_data)
         logger.info(f"New user registered: {user_id} (@{user_data['username']})")
 
     await update.message.reply_text(MESSAGES["welcome"])
@@ -40,7 +51,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /status command"""
     user_id = update.effective_user.id
-    subscription = SubscriptionManager.get_user_subscription(user_id)
+    subscription = await SubscriptionManager.aget_user_subscription(user_id)
     
     if not subscription:
         logger.info(f"User {user_id} checked status: No active subscription")
@@ -65,11 +76,19 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"User {user_id} started subscription process")
     
+    if robokassa.is_configured():
+        # Each button opens the payment page of its plan
+        await update.message.reply_text(
+            "Please select your subscription plan:",
+            reply_markup=await payment_keyboard(user_id)
+        )
+        return ConversationHandler.END
+
     keyboard = []
-    for sub_type, sub_data in SUBSCRIPTION_TYPES.items():
+    for sub_type in SUBSCRIPTION_TYPES:
         keyboard.append([
             InlineKeyboardButton(
-                f"{sub_type.title()} - ${sub_data['price']}/month",
+                plan_label(sub_type),
                 callback_data=f"sub_{sub_type}"
             )
         ])
@@ -81,13 +100,35 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return SELECTING_SUBSCRIPTION
 
+def plan_label(sub_type: str) -> str:
+    """Get the button text of a plan"""
+    return f"{sub_type.title()} - ${SUBSCRIPTION_TYPES[sub_type]['price']}/month"
+
+async def payment_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """Build buttons linking to the signed payment page of every plan"""
+    urls = await robokassa.payment_urls(user_id)
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(plan_label(sub_type), url=url)] for sub_type, url in urls.items()
+    ])
+
 async def subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle subscription selection"""
     query = update.callback_query
     await query.answer()
+
+    tap = (query.message.chat_id, query.message.message_id, query.from_user.id, query.data)
+    if handled_updates.begin(update.update_id) is not None:
+        logger.info(f"Ignoring repeated subscription selection from user {query.from_user.id}")
+        return ConversationHandler.END
+    if handled_taps.begin(tap) is not None:
+        handled_updates.abort(update.update_id)
+        logger.info(f"Ignoring repeated subscription selection from user {query.from_user.id}")
+        return ConversationHandler.END
     
     if not query.data.startswith("sub_"):
         logger.warning(f"Invalid subscription selection from user {query.from_user.id}")
+        handled_updates.abort(update.update_id)
+        handled_taps.abort(tap)
         await query.message.reply_text("Invalid selection. Please try again.")
         return ConversationHandler.END
     
@@ -97,42 +138,45 @@ async def subscription_callback(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         logger.info(f"User {user_id} selected {subscription_type} subscription")
         
-        # Create subscription
-        subscription_id = SubscriptionManager.create_subscription(user_id, subscription_type)
-        logger.info(f"Created subscription {subscription_id} for user {user_id}")
-        
-        # Get groups for this subscription
-        groups = SUBSCRIPTION_TYPES[subscription_type]["groups"]
-        
-        # Create invite links for each group
-        invite_links = []
-        for group_id in groups:
-            try:
-                invite_link = await context.bot.create_chat_invite_link(
-                    chat_id=group_id,
-                    member_limit=1,
-                    expire_date=int(query.message.date.timestamp()) + 24 * 60 * 60
-                )
-                invite_links.append(f"- {invite_link.invite_link}")
-                logger.info(f"Created invite link for group {group_id} for user {user_id}")
-            except Exception as e:
-                logger.error(f"Error creating invite link for group {group_id}: {e}")
-                continue
-        
-        # Send success message with invite links
-        success_message = MESSAGES["subscription_success"].format(
-            invite_links="\n".join(invite_links)
-        )
-        await query.message.reply_text(success_message)
+        await agrant_subscription(user_id, subscription_type)
         logger.info(f"Subscription process completed for user {user_id}")
         
     except Exception as e:
+        # Let the user try the same button again
+        handled_updates.abort(update.update_id)
+        handled_taps.abort(tap)
         error_msg = f"Error creating subscription: {str(e)}"
         logger.error(f"Subscription error for user {user_id}: {e}")
         await query.message.reply_text(error_msg)
-    
+        return ConversationHandler.END
+
+    handled_updates.finish(update.update_id)
+    handled_taps.finish(tap)
     return ConversationHandler.END
 
+async def join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Approve join requests from subscribers with access to the group, decline the rest"""
+    request = update.chat_join_request
+    user_id = request.from_user.id
+    group_id = request.chat.id
+
+    try:
+        if await SubscriptionManager.ahas_group_access(user_id, group_id):
+            await context.bot.approve_chat_join_request(
+                chat_id=group_id, user_id=user_id, rate_limit_args=priority(PRIORITY_PAYMENT)
+            )
+            logger.info(f"Approved join request of user {user_id} for group {group_id}")
+        else:
+            await context.bot.decline_chat_join_request(
+                chat_id=group_id, user_id=user_id, rate_limit_args=priority(PRIORITY_PAYMENT)
+            )
+            logger.info(f"Declined join request of user {user_id} for group {group_id}: no access")
+    except (BadRequest, Forbidden) as e:
+        # Most often the request was already handled, e.g. by an admin
+        logger.warning(f"Could not answer join request of user {user_id} for group {group_id}: {e}")
+
+join_request_handler = ChatJoinRequestHandler(join_request)
+
 # Create conversation handler
 subscription_handler = ConversationHandler(
     entry_points=[CommandHandler("subscribe", subscribe)],
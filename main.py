@@ -1,11 +1,25 @@
 import logging
+from telegram import Update
 from telegram.ext import Application, CommandHandler, ConversationHandler
 from datetime import datetime
 import sys
 
 from config import BOT_TOKEN, MESSAGES
-from handlers.user import start, help_command, status, subscription_handler
-from handlers.admin import admin_command, list_users, admin_handler
+from handlers.user import start, help_command, status, subscription_handler, join_request_handler
+from handlers.admin import admin_command, list_users, reconcile_command, failed_removals_command, admin_handler
+from handlers.group import chat_member_handler
+from utils.entitlements import Entitlements
+from utils.expiry_scheduler import ExpiryScheduler
+from utils.invite_link_pool import InviteLinkPool
+from utils.invite_links import InviteLinkRetryQueue
+from utils.payment_server import PaymentServer
+from utils.outbox import Outbox
+from utils.json_handler import JsonHandler
+from utils.join_requests import JoinRequestLinks, join_requests_enabled
+from utils.reconciler import MembershipReconciler
+from utils.subscription_manager import RemovalRetryQueue, SubscriptionManager
+from utils.rate_limiter import TelegramRateLimiter
+from utils.telegram_client import build_request
 
 # Configure logging
 logging.basicConfig(
@@ -44,12 +58,33 @@ async def error_handler(update, context):
         await update.effective_message.reply_text(response)
         await log_response(update, response)
 
+async def post_init(application):
+    """Prepare state and start background services once the event loop runs"""
+    # Build the access index off the event loop, so no handler pays for the storage scan
+    await JsonHandler.run_async(Entitlements.build)
+    await PaymentServer.start(application)
+
+async def post_stop(application):
+    """Stop background services while the bot is still initialized, before Application.shutdown"""
+    await PaymentServer.stop(application)
+    await Outbox.stop(application)
+
 def main():
     """Start the bot"""
     logger.info("Starting bot...")
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(build_request())
+        .rate_limiter(TelegramRateLimiter())
+        # Serve Robokassa callbacks in the same event loop as the bot
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
+    SubscriptionManager.set_bot(application.bot)
 
     # Add handlers with logging
     async def logged_start(update, context):
@@ -80,23 +115,56 @@ def main():
         response = await list_users(update, context)
         return response
 
+    async def logged_reconcile(update, context):
+        await log_command(update, context, "reconcile")
+        response = await reconcile_command(update, context)
+        return response
+
+    async def logged_failed_removals(update, context):
+        await log_command(update, context, "failed_removals")
+        response = await failed_removals_command(update, context)
+        return response
+
     # Add handlers
     application.add_handler(CommandHandler("start", logged_start))
     application.add_handler(CommandHandler("help", logged_help))
     application.add_handler(CommandHandler("status", logged_status))
     application.add_handler(subscription_handler)
+    if join_requests_enabled():
+        application.add_handler(join_request_handler)
     
     # Admin handlers
     application.add_handler(CommandHandler("admin", logged_admin))
     application.add_handler(CommandHandler("list_users", logged_list_users))
+    application.add_handler(CommandHandler("reconcile", logged_reconcile))
+    application.add_handler(CommandHandler("failed_removals", logged_failed_removals))
     application.add_handler(admin_handler)
 
+    # Track who is in the managed groups
+    application.add_handler(chat_member_handler)
+
     # Add error handler
     application.add_error_handler(error_handler)
 
+    # Expire subscriptions automatically when they end
+    ExpiryScheduler.start(application)
+    RemovalRetryQueue.start(application)
+
+    # Perform side effects committed together with payments
+    Outbox.start(application)
+
+    # Keep invite links ready so paying users get them without waiting
+    InviteLinkPool.start(application)
+    InviteLinkRetryQueue.start(application)
+    JoinRequestLinks.start(application)
+
+    # Correct drift between group membership and subscriptions
+    MembershipReconciler.start(application)
+
     # Start the bot
     logger.info("Bot is ready to handle messages")
-    application.run_polling()
+    # chat_member updates are only sent when asked for explicitly
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,82 @@
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import ExtBot
+
+from config import MESSAGES, SUBSCRIPTION_TYPES
+from utils.entitlements import Entitlements
+from utils.expiry_scheduler import ExpiryScheduler
+from utils.invite_links import InviteLinkRetryQueue, create_invite_links, format_invite_links
+from utils.json_handler import JsonHandler
+from utils.outbox import Outbox
+from utils.rate_limiter import PRIORITY_PAYMENT, priority
+from utils.subscription_manager import SubscriptionManager, UnbanScheduler
+
+# Outbox entry kind sending a new subscriber their invite links
+DELIVER_ACCESS = "deliver_access"
+
+logger = logging.getLogger(__name__)
+
+def grant_subscription(user_id: int, subscription_type: str,
+                       inv_id: Optional[int] = None, payment: Optional[Dict] = None) -> Tuple[str, str]:
+    """Create a subscription and queue the delivery of its invite links in one transaction.
+
+    If the invoice that paid for it is given, it is marked activated in the same
+    transaction. Returns the IDs of the new subscription and of its outbox entry."""
+    with JsonHandler.transaction():
+        subscription_id = SubscriptionManager.create_subscription(user_id, subscription_type)
+        end_date = JsonHandler.get_subscription(subscription_id)["end_date"]
+        if payment is not None:
+            payment.update(status="activated", subscription_id=subscription_id, activated_at=int(time.time()))
+            JsonHandler.save_payment(inv_id, payment)
+        entry_id = Outbox.add(DELIVER_ACCESS, {
+            "user_id": user_id,
+            "subscription_type": subscription_type,
+            "subscription_id": subscription_id,
+        })
+    # Only once committed, so a rolled back subscription never grants access
+    Entitlements.grant(user_id, subscription_type, end_date)
+    logger.info(f"Created subscription {subscription_id} for user {user_id}")
+    return subscription_id, entry_id
+
+async def agrant_subscription(user_id: int, subscription_type: str,
+                              inv_id: Optional[int] = None, payment: Optional[Dict] = None) -> str:
+    """Create a subscription without blocking the event loop and start delivering its invite links.
+
+    Returns the ID of the new subscription."""
+    subscription_id, entry_id = await JsonHandler.run_async(
+        grant_subscription, user_id, subscription_type, inv_id, payment
+    )
+    await ExpiryScheduler.reschedule()
+    Outbox.wake(entry_id)
+    return subscription_id
+
+async def deliver_access(bot: ExtBot, entry_id: str, payload: Dict):
+    """Send a new subscriber their invite links.
+
+    The links are saved in the payload once created, so a retry after a failed
+    message sends the same links instead of creating new ones."""
+    user_id = payload["user_id"]
+    if "links" not in payload:
+        groups = SUBSCRIPTION_TYPES[payload["subscription_type"]]["groups"]
+        # A user renewing soon after being removed may still be banned from their groups
+        await UnbanScheduler.unban_if_banned(user_id, groups)
+
+        # Create invite links for all groups at once
+        links = await create_invite_links(bot, user_id, groups)
+        failed_groups = [group_id for group_id, link in links.items() if link is None]
+        if failed_groups:
+            # Send the missing links in a follow-up message once they can be created
+            await InviteLinkRetryQueue.add(user_id, failed_groups)
+        payload["links"] = {str(group_id): link for group_id, link in links.items()}
+        await Outbox.checkpoint(entry_id, payload)
+
+    links = {int(group_id): link for group_id, link in payload["links"].items()}
+    await bot.send_message(
+        chat_id=user_id,
+        text=MESSAGES["subscription_success"].format(invite_links=format_invite_links(links)),
+        rate_limit_args=priority(PRIORITY_PAYMENT)
+    )
+
+Outbox.register(DELIVER_ACCESS, deliver_access)
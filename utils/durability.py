@@ -0,0 +1,172 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import config
+
+# "always" - fsync every write before returning
+# "group"  - batch writes and fsync them together every GROUP_COMMIT_INTERVAL_MS
+#            milliseconds or every GROUP_COMMIT_MAX_WRITES writes, whichever comes first;
+#            a write returns once the batch holding it is on disk
+# "none"   - never fsync, leave flushing to the OS
+DURABILITY_MODE = getattr(config, "DURABILITY_MODE", "always")
+GROUP_COMMIT_INTERVAL_MS = getattr(config, "GROUP_COMMIT_INTERVAL_MS", 50)
+GROUP_COMMIT_MAX_WRITES = getattr(config, "GROUP_COMMIT_MAX_WRITES", 100)
+
+logger = logging.getLogger(__name__)
+
+class Durability:
+    _condition = threading.Condition()
+    _flush_lock = threading.Lock()
+    # Pending flush callbacks keyed by file path; a later write to the same
+    # file replaces the earlier callback, so each file is flushed once per batch
+    _pending: Dict[str, Callable[[], None]] = {}
+    _pending_writes = 0
+    _first_pending_at = 0.0
+    _thread = None
+    # Number of the batch being collected, and of the last batch flushed
+    _batch = 1
+    _flushed = 0
+    # Batch number -> error of a batch whose flush failed, for its writers to raise
+    _errors: Dict[int, Exception] = {}
+
+    @staticmethod
+    def should_sync() -> bool:
+        """Check if flushes should fsync"""
+        return DURABILITY_MODE != "none"
+
+    @staticmethod
+    def sync_directory(dir_path: str):
+        """Fsync a directory so a rename inside it survives a crash"""
+        try:
+            fd = os.open(dir_path or ".", os.O_RDONLY)
+        except OSError:
+            # Directories cannot be opened on Windows
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def sync_file(file_path: str):
+        """Fsync an existing file"""
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def write_atomic(file_path: str, text: str):
+        """Replace a file through a temp file and rename, so readers never see a partial write"""
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            if Durability.should_sync():
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+        if Durability.should_sync():
+            Durability.sync_directory(os.path.dirname(file_path))
+
+    @staticmethod
+    def commit(file_path: str, flush: Callable[[], None]) -> int:
+        """Run a file's flush callback now, or batch it in "group" mode.
+
+        Returns a ticket to pass to wait() once the caller has released its
+        locks, as flushing may need them."""
+        if DURABILITY_MODE != "group":
+            flush()
+            return 0
+
+        with Durability._condition:
+            if not Durability._pending:
+                Durability._first_pending_at = time.monotonic()
+            Durability._pending[file_path] = flush
+            Durability._pending_writes += 1
+            if Durability._thread is None:
+                Durability._thread = threading.Thread(
+                    target=Durability._run, name="group-commit", daemon=True
+                )
+                Durability._thread.start()
+            Durability._condition.notify_all()
+            return Durability._batch
+
+    @staticmethod
+    def wait(ticket: int):
+        """Wait until the batch of a ticket from commit() is flushed.
+
+        Raises the error of a failed flush, so the write is not taken as durable."""
+        if not ticket:
+            return
+        with Durability._condition:
+            while Durability._flushed < ticket:
+                Durability._condition.wait()
+            error = Durability._errors.get(ticket)
+        if error is not None:
+            raise IOError(f"Write was not flushed to disk: {error}")
+
+    @staticmethod
+    def _take_batch() -> Tuple[int, Dict[str, Callable[[], None]]]:
+        """Take all pending flush callbacks and their batch number; caller must hold the condition"""
+        number = Durability._batch
+        batch = Durability._pending
+        Durability._batch += 1
+        Durability._pending = {}
+        Durability._pending_writes = 0
+        return number, batch
+
+    @staticmethod
+    def _flush_batch(batch: Dict[str, Callable[[], None]]) -> Optional[Exception]:
+        """Run a batch of flush callbacks, returning the first error"""
+        first_error = None
+        for file_path, flush in batch.items():
+            try:
+                flush()
+            except Exception as e:
+                logger.error(f"Failed to flush {file_path}: {e}")
+                first_error = first_error or e
+        return first_error
+
+    @staticmethod
+    def _run():
+        """Group commit loop"""
+        interval = GROUP_COMMIT_INTERVAL_MS / 1000
+        while True:
+            with Durability._condition:
+                while not Durability._pending:
+                    Durability._condition.wait()
+                deadline = Durability._first_pending_at + interval
+                while Durability._pending and Durability._pending_writes < GROUP_COMMIT_MAX_WRITES:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    Durability._condition.wait(remaining)
+            Durability.flush()
+
+    @staticmethod
+    def flush():
+        """Flush all pending writes immediately, waiting for any batch already in progress"""
+        with Durability._flush_lock:
+            with Durability._condition:
+                number, batch = Durability._take_batch()
+            error = Durability._flush_batch(batch)
+            with Durability._condition:
+                if error is not None:
+                    Durability._errors[number] = error
+                # Writers of older batches have long stopped waiting
+                for old in [old for old in Durability._errors if old < number - 1000]:
+                    del Durability._errors[old]
+                Durability._flushed = number
+                Durability._condition.notify_all()
+
+atexit.register(Durability.flush)
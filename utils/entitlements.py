@@ -0,0 +1,139 @@
+import threading
+import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from config import SUBSCRIPTION_TYPES
+from utils.json_handler import JsonHandler
+
+class Entitlements:
+    """In-memory index of which groups each subscriber may be in, and until when.
+
+    Built once from storage and then kept up to date by SubscriptionManager as
+    subscriptions are created and expired, so access checks are dict lookups.
+
+    Storage is read without holding _lock, because grant() and revoke() may be
+    called by a thread holding the storage lock. Changes made while a build
+    reads storage are recorded and applied to the new index before it is used."""
+    _lock = threading.RLock()
+    # Held for a whole build, so builds do not overlap
+    _build_lock = threading.Lock()
+    _built = False
+    # User ID -> (group IDs in plan order, the same as a set, end_date) of the user's active subscription
+    _users: Dict[int, Tuple[Tuple[int, ...], FrozenSet[int], int]] = {}
+    # Group ID -> IDs of users with an active subscription that includes it
+    _members: Dict[int, Set[int]] = {}
+    # Changes made during a running build as (user ID, (subscription type, end_date) or None)
+    _changes: Optional[List[Tuple[int, Optional[Tuple[str, int]]]]] = None
+
+    @staticmethod
+    def build():
+        """Rebuild the index from the stored users and subscriptions"""
+        with Entitlements._build_lock:
+            with Entitlements._lock:
+                Entitlements._changes = []
+            try:
+                users = {}
+                members = {}
+                for user_id, user_data in JsonHandler.get_all_users().items():
+                    subscription_id = user_data.get("subscription_id")
+                    if not subscription_id:
+                        continue
+                    subscription = JsonHandler.get_subscription(subscription_id)
+                    if not subscription or subscription["status"] != "active":
+                        continue
+                    Entitlements._set(users, members, int(user_id), subscription["type"], subscription["end_date"])
+            except BaseException:
+                with Entitlements._lock:
+                    Entitlements._changes = None
+                raise
+
+            with Entitlements._lock:
+                for user_id, change in Entitlements._changes:
+                    Entitlements._remove(users, members, user_id)
+                    if change is not None:
+                        Entitlements._set(users, members, user_id, *change)
+                Entitlements._changes = None
+                Entitlements._users = users
+                Entitlements._members = members
+                Entitlements._built = True
+
+    @staticmethod
+    def is_built() -> bool:
+        """Check if lookups are answered from memory without touching storage"""
+        return Entitlements._built
+
+    @staticmethod
+    def _ensure_built():
+        if not Entitlements._built:
+            Entitlements.build()
+
+    @staticmethod
+    def grant(user_id: int, subscription_type: str, end_date: int):
+        """Record that a user's current subscription is of a type and ends at end_date.
+
+        Call it once the subscription is committed to storage."""
+        Entitlements._record(user_id, (subscription_type, end_date))
+
+    @staticmethod
+    def revoke(user_id: int):
+        """Record that a user no longer has an active subscription"""
+        Entitlements._record(user_id, None)
+
+    @staticmethod
+    def _record(user_id: int, change: Optional[Tuple[str, int]]):
+        with Entitlements._lock:
+            if Entitlements._changes is not None:
+                Entitlements._changes.append((user_id, change))
+            # Before the first build there is nothing to update; the build reads storage
+            if Entitlements._built:
+                Entitlements._remove(Entitlements._users, Entitlements._members, user_id)
+                if change is not None:
+                    Entitlements._set(Entitlements._users, Entitlements._members, user_id, *change)
+
+    @staticmethod
+    def _set(users: Dict, members: Dict, user_id: int, subscription_type: str, end_date: int):
+        groups = tuple(SUBSCRIPTION_TYPES[subscription_type]["groups"])
+        users[user_id] = (groups, frozenset(groups), end_date)
+        for group_id in groups:
+            members.setdefault(group_id, set()).add(user_id)
+
+    @staticmethod
+    def _remove(users: Dict, members: Dict, user_id: int):
+        entry = users.pop(user_id, None)
+        if entry is None:
+            return
+        for group_id in entry[0]:
+            group_members = members.get(group_id)
+            if group_members is not None:
+                group_members.discard(user_id)
+    @staticmethod
+    def is_active(user_id: int) -> bool:
+        """Check if a user has an active subscription that has not ended yet"""
+        Entitlements._ensure_built()
+        entry = Entitlements._users.get(user_id)
+        return entry is not None and entry[2] > time.time()
+
+    @staticmethod
+    def groups(user_id: int) -> List[int]:
+        """Get the groups of a user's active subscription"""
+        Entitlements._ensure_built()
+        entry = Entitlements._users.get(user_id)
+        return list(entry[0]) if entry else []
+
+    @staticmethod
+    def has_access(user_id: int, group_id: int) -> bool:
+        """Check if a user's active, not yet ended subscription includes a group"""
+        Entitlements._ensure_built()
+        entry = Entitlements._users.get(user_id)
+        return entry is not None and group_id in entry[1] and entry[2] > time.time()
+
+    @staticmethod
+    def members(group_id: int) -> Set[int]:
+        """Get the users whose active, not yet ended subscription includes a group"""
+        Entitlements._ensure_built()
+        now = time.time()
+        with Entitlements._lock:
+            return {
+                user_id for user_id in Entitlements._members.get(group_id, ())
+                if Entitlements._users[user_id][2] > now
+            }
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import sys
+import time
+from typing import Dict, Optional
+
+from telegram.ext import Application, ContextTypes, ExtBot
+
+import config
+from config import MESSAGES
+from utils.json_handler import JsonHandler
+from utils.rate_limiter import PRIORITY_BACKGROUND, priority
+from utils.subscription_manager import SubscriptionManager
+
+# Subscriptions expired per batch, and how many of a batch are expired at once
+EXPIRY_BATCH_SIZE = getattr(config, "EXPIRY_BATCH_SIZE", 50)
+EXPIRY_CONCURRENCY = getattr(config, "EXPIRY_CONCURRENCY", 5)
+# Longest time in seconds between runs, so data changed outside the bot is picked up
+EXPIRY_MAX_SLEEP = getattr(config, "EXPIRY_MAX_SLEEP", 60 * 60)
+# Seconds before subscriptions that failed to expire are tried again
+EXPIRY_RETRY_DELAY = getattr(config, "EXPIRY_RETRY_DELAY", 60)
+
+JOB_NAME = "expire_subscriptions"
+# State entry holding the end_date up to which all due subscriptions were handled
+CURSOR_STATE = "expiry_cursor"
+
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    _application: Optional[Application] = None
+    _next_run: Optional[float] = None
+    # Set while a run is expiring subscriptions; it schedules the next run itself when done
+    _running = False
+
+    @staticmethod
+    def start(application: Application):
+        """Start expiring subscriptions in the background of an application"""
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, subscriptions will not expire automatically. "
+                           "Install python-telegram-bot[job-queue] to enable it.")
+            return
+        ExpiryScheduler._application = application
+        # Catch up with everything that expired while the bot was down
+        ExpiryScheduler._schedule(time.time())
+
+    @staticmethod
+    def _schedule(when: float):
+        """Schedule the next run at a unix time, replacing the one already scheduled"""
+        job_queue = ExpiryScheduler._application.job_queue
+        for job in job_queue.get_jobs_by_name(JOB_NAME):
+            job.schedule_removal()
+        ExpiryScheduler._next_run = when
+        job_queue.run_once(ExpiryScheduler._run, when=max(0.0, when - time.time()), name=JOB_NAME)
+
+    @staticmethod
+    async def reschedule(force: bool = False, not_before: float = 0):
+        """Schedule the next run for the earliest due subscription, but not before a unix time.
+
+        Unless force is set, an already scheduled earlier run is kept. While a run
+        is in progress nothing is scheduled, as the run reschedules from storage
+        when it ends and so sees whatever changed in the meantime."""
+        if ExpiryScheduler._application is None or ExpiryScheduler._running:
+            return
+        cursor = await JsonHandler.aget_state(CURSOR_STATE) or 0
+        upcoming = await SubscriptionManager.aexpiring_between(cursor, sys.maxsize, 1)
+        when = time.time() + EXPIRY_MAX_SLEEP
+        for subscription in upcoming.values():
+            when = min(when, subscription["end_date"])
+        when = max(when, not_before)
+        if force or ExpiryScheduler._next_run is None or when < ExpiryScheduler._next_run:
+            ExpiryScheduler._schedule(when)
+            logger.info(f"Next subscription expiry check at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))}")
+
+    @staticmethod
+    async def _run(context: ContextTypes.DEFAULT_TYPE):
+        """Expire all due subscriptions in batches, then schedule the next run"""
+        if ExpiryScheduler._running:
+            return
+        ExpiryScheduler._running = True
+        # Earliest end_date of a subscription that failed to expire in this run
+        first_failed = None
+        try:
+            now = int(time.time())
+            cursor = await JsonHandler.aget_state(CURSOR_STATE) or 0
+            while True:
+                due = await SubscriptionManager.aexpiring_between(cursor, now + 1, EXPIRY_BATCH_SIZE)
+                if due:
+                    failed = await ExpiryScheduler._expire_batch(context.bot, due)
+                    if failed:
+                        earliest = min(subscription["end_date"] for subscription in failed.values())
+                        first_failed = earliest if first_failed is None else min(first_failed, earliest)
+
+                if len(due) < EXPIRY_BATCH_SIZE:
+                    cursor = now + 1
+                else:
+                    # More may be due at the last end_date of a full batch. Subscriptions
+                    # that failed to expire stay active, so if a whole batch shares one
+                    # end_date the cursor has to move past it to make progress.
+                    last_end_date = max(subscription["end_date"] for subscription in due.values())
+                    cursor = last_end_date if last_end_date > cursor else last_end_date + 1
+                # Failed subscriptions stay active, so holding the stored cursor at the
+                # first of them makes the next run try them again
+                await JsonHandler.asave_state(CURSOR_STATE, cursor if first_failed is None else min(cursor, first_failed))
+                if len(due) < EXPIRY_BATCH_SIZE:
+                    break
+        except Exception as e:
+            logger.error(f"Subscription expiry run failed: {e}")
+        finally:
+            ExpiryScheduler._running = False
+            not_before = 0 if first_failed is None else time.time() + EXPIRY_RETRY_DELAY
+            await ExpiryScheduler.reschedule(force=True, not_before=not_before)
+
+    @staticmethod
+    async def _expire_batch(bot: ExtBot, due: Dict[str, Dict]) -> Dict[str, Dict]:
+        """Expire a batch of subscriptions, a few at a time.
+
+        Returns the subscriptions that failed to expire, keyed by subscription ID."""
+        semaphore = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+        failed = {}
+
+        async def expire(subscription_id: str, subscription: Dict):
+            user_id = subscription["user_id"]
+            async with semaphore:
+                try:
+                    expired = await SubscriptionManager.expire_subscription(user_id, subscription_id)
+                except Exception as e:
+                    logger.error(f"Failed to expire subscription {subscription_id} for user {user_id}: {e}")
+                    failed[subscription_id] = subscription
+                    return
+                if expired:
+                    try:
+                        await bot.send_message(
+                            chat_id=user_id,
+                            text=MESSAGES["subscription_expired"],
+                            rate_limit_args=priority(PRIORITY_BACKGROUND)
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to notify user {user_id} of expired subscription {subscription_id}: {e}")
+
+        logger.info(f"Expiring {len(due)} subscriptions")
+        await asyncio.gather(*(
+            expire(subscription_id, subscription) for subscription_id, subscription in due.items()
+        ))
+        return failed
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+PENDING = "pending"
+DONE = "done"
+
+class IdempotencyStore:
+    """Remembers recently seen keys so duplicate deliveries can be skipped.
+
+    A key is begun when work for it starts and finished once the work is done,
+    or aborted if it failed so a redelivery can try again. Keys are forgotten
+    ttl seconds after they were last begun or finished. Lookups are O(1), and
+    as every key lives for the same ttl the oldest entries are always at the
+    front, so eviction is amortized O(1) as well."""
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Key -> (state, unix time it expires), oldest first
+        self._entries: OrderedDict = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._entries:
+            key, (state, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_size:
+                break
+            self._entries.popitem(last=False)
+
+    def _set(self, key: Hashable, state: str, now: float):
+        self._entries[key] = (state, now + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def state(self, key: Hashable) -> Optional[str]:
+        """Get PENDING or DONE for a known key, or None"""
+        now = time.time()
+        self._evict(now)
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def begin(self, key: Hashable) -> Optional[str]:
+        """Start work for a key.
+
+        Returns None if the key is new and the caller should do the work,
+        otherwise the key's state: PENDING while another delivery is being
+        handled, DONE once it was."""
+        existing = self.state(key)
+        if existing is not None:
+            return existing
+        self._set(key, PENDING, time.time())
+        return None
+
+    def finish(self, key: Hashable):
+        """Mark the work for a key as done"""
+        self._set(key, DONE, time.time())
+
+    def abort(self, key: Hashable):
+        """Forget a key whose work failed, so it can be tried again"""
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from telegram.ext import Application, ContextTypes
+
+import config
+from config import GROUP_IDS
+from utils.join_requests import join_requests_enabled
+from utils.json_handler import JsonHandler
+from utils.rate_limiter import PRIORITY_BACKGROUND, priority
+
+# Unused single-use invite links kept ready per group
+INVITE_LINK_POOL_SIZE = getattr(config, "INVITE_LINK_POOL_SIZE", 5)
+# Lifetime of a pooled link in seconds, and the least it must have left to be handed out
+INVITE_LINK_POOL_TTL = getattr(config, "INVITE_LINK_POOL_TTL", 3 * 24 * 60 * 60)
+INVITE_LINK_MIN_REMAINING = getattr(config, "INVITE_LINK_MIN_REMAINING", 24 * 60 * 60)
+# Seconds between checks that top up the pool and revoke stale links
+INVITE_LINK_POOL_REFILL_INTERVAL = getattr(config, "INVITE_LINK_POOL_REFILL_INTERVAL", 5 * 60)
+
+JOB_NAME = "refill_invite_link_pool"
+# State entry holding the pooled links, so they are reused after a restart
+POOL_STATE = "invite_link_pool"
+
+logger = logging.getLogger(__name__)
+
+class InviteLinkPool:
+    """Keeps ready-made single-use invite links for every group in GROUP_IDS"""
+    _application: Optional[Application] = None
+    # Group ID -> list of {"invite_link": ..., "expire_date": ...}, soonest to expire first
+    _links: Dict[int, List[Dict]] = {}
+    _refill_lock: Optional[asyncio.Lock] = None
+    _refill_requested = False
+    _refill_task: Optional[asyncio.Task] = None
+    _loaded = False
+
+    @staticmethod
+    def start(application: Application):
+        """Fill the pool now and keep it topped up in the background"""
+        if join_requests_enabled():
+            # Subscribers share one join-request link per group instead
+            return
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, invite links will be created on demand.")
+            return
+        InviteLinkPool._application = application
+        application.job_queue.run_repeating(
+            InviteLinkPool._refill_job, interval=INVITE_LINK_POOL_REFILL_INTERVAL, first=0, name=JOB_NAME
+        )
+
+    @staticmethod
+    async def _refill_job(context: ContextTypes.DEFAULT_TYPE):
+        await InviteLinkPool.refill()
+
+    @staticmethod
+    async def take(group_id: int) -> Optional[str]:
+        """Take a ready invite link for a group, or None if the pool has none"""
+        if InviteLinkPool._application is None:
+            return None
+        links = InviteLinkPool._links.get(group_id, [])
+        min_expire_date = time.time() + INVITE_LINK_MIN_REMAINING
+        invite_link = None
+        for position, link in enumerate(links):
+            # Stale links at the front are left for refill() to revoke
+            if link["expire_date"] >= min_expire_date:
+                invite_link = links.pop(position)["invite_link"]
+                break
+        if invite_link is not None and InviteLinkPool._loaded:
+            # Saved before it is handed out, so a restart cannot hand it out again
+            try:
+                await InviteLinkPool._save()
+            except Exception as e:
+                # The saved pool still has it, so it must not be used
+                logger.error(f"Could not save invite link pool for group {group_id}: {e}")
+                invite_link = None
+        # Top the pool up again, or have the refill already under way go round once more
+        if InviteLinkPool._refill_task is None or InviteLinkPool._refill_task.done():
+            InviteLinkPool._refill_task = asyncio.get_running_loop().create_task(InviteLinkPool.refill())
+        else:
+            InviteLinkPool._refill_requested = True
+        return invite_link
+
+    @staticmethod
+    async def _load():
+        """Load links pooled before a restart"""
+        saved = await JsonHandler.aget_state(POOL_STATE) or {}
+        InviteLinkPool._links = {int(group_id): links for group_id, links in saved.items()}
+
+    @staticmethod
+    async def _save():
+        """Persist the pooled links"""
+        await JsonHandler.asave_state(POOL_STATE, {str(group_id): list(links) for group_id, links in InviteLinkPool._links.items()})
+
+    @staticmethod
+    async def refill():
+        """Revoke stale links and create new ones until every group's pool is full"""
+        if InviteLinkPool._application is None:
+            return
+        if InviteLinkPool._refill_lock is None:
+            InviteLinkPool._refill_lock = asyncio.Lock()
+        if InviteLinkPool._refill_lock.locked():
+            # Let the running refill go round once more
+            InviteLinkPool._refill_requested = True
+            return
+
+        async with InviteLinkPool._refill_lock:
+            if not InviteLinkPool._loaded:
+                await InviteLinkPool._load()
+                InviteLinkPool._loaded = True
+            InviteLinkPool._refill_requested = False
+            await InviteLinkPool._refill_all()
+            while InviteLinkPool._refill_requested:
+                InviteLinkPool._refill_requested = False
+                await InviteLinkPool._refill_all()
+
+    @staticmethod
+    async def _refill_all():
+        """Refill the pools of all groups once"""
+        bot = InviteLinkPool._application.bot
+        min_expire_date = time.time() + INVITE_LINK_MIN_REMAINING
+        for group_id in GROUP_IDS:
+            links = InviteLinkPool._links.setdefault(group_id, [])
+
+            stale = [link for link in links if link["expire_date"] < min_expire_date]
+            links[:] = [link for link in links if link["expire_date"] >= min_expire_date]
+            for link in stale:
+                try:
+                    await bot.revoke_chat_invite_link(
+                        chat_id=group_id,
+                        invite_link=link["invite_link"],
+                        rate_limit_args=priority(PRIORITY_BACKGROUND)
+                    )
+                except Exception as e:
+                    # It expires on its own anyway
+                    logger.warning(f"Could not revoke stale invite link for group {group_id}: {e}")
+
+            while len(links) < INVITE_LINK_POOL_SIZE:
+                expire_date = int(time.time()) + INVITE_LINK_POOL_TTL
+                try:
+                    invite_link = await bot.create_chat_invite_link(
+                        chat_id=group_id,
+                        member_limit=1,
+                        expire_date=expire_date,
+                        rate_limit_args=priority(PRIORITY_BACKGROUND)
+                    )
+                except Exception as e:
+                    logger.error(f"Error creating pooled invite link for group {group_id}: {e}")
+                    break
+                links.append({"invite_link": invite_link.invite_link, "expire_date": expire_date})
+
+        await InviteLinkPool._save()
@@ -0,0 +1,154 @@
+import asyncio
+import copy
+import logging
+import time
+from typing import Dict, List, Optional
+
+from telegram.ext import Application, ContextTypes, ExtBot
+
+import config
+from config import MESSAGES
+from utils.invite_link_pool import InviteLinkPool
+from utils.join_requests import JoinRequestLinks, join_requests_enabled
+from utils.json_handler import JsonHandler
+from utils.rate_limiter import PRIORITY_BACKGROUND, PRIORITY_PAYMENT, priority
+from utils.subscription_manager import SubscriptionManager
+
+# Lifetime in seconds of an invite link created for a user
+INVITE_LINK_TTL = getattr(config, "INVITE_LINK_TTL", 24 * 60 * 60)
+# Seconds before the first retry of a failed invite link, doubled after each failure up to the maximum
+INVITE_LINK_RETRY_DELAY = getattr(config, "INVITE_LINK_RETRY_DELAY", 30)
+INVITE_LINK_RETRY_MAX_DELAY = getattr(config, "INVITE_LINK_RETRY_MAX_DELAY", 30 * 60)
+# Retries before a user's missing links are given up on
+INVITE_LINK_MAX_RETRIES = getattr(config, "INVITE_LINK_MAX_RETRIES", 10)
+
+JOB_NAME = "retry_invite_links"
+# State entry holding the users still waiting for invite links
+RETRY_STATE = "invite_link_retries"
+
+DEFAULT_FOLLOWUP_MESSAGE = """
+Вот оставшиеся пригласительные ссылки для входа в группы:
+{invite_links}
+
+Ссылки действительны в течение 24 часов.
+"""
+
+logger = logging.getLogger(__name__)
+
+async def create_invite_links(bot: ExtBot, user_id: int, groups: List[int], lane: str = PRIORITY_PAYMENT) -> Dict[int, Optional[str]]:
+    """Get an invite link for each group at once.
+
+    In join-request mode this is the group's shared link. Otherwise it is a
+    single-use link, taken from the pool where possible. Returns the link of
+    each group, or None for groups where creating one failed."""
+    async def create(group_id: int) -> Optional[str]:
+        if join_requests_enabled():
+            shared_link = JoinRequestLinks.get(group_id)
+            if shared_link:
+                return shared_link
+        pooled_link = await InviteLinkPool.take(group_id)
+        if pooled_link:
+            logger.info(f"Used pooled invite link for group {group_id} for user {user_id}")
+            return pooled_link
+        try:
+            invite_link = await bot.create_chat_invite_link(
+                chat_id=group_id,
+                member_limit=1,
+                expire_date=int(time.time()) + INVITE_LINK_TTL,
+                rate_limit_args=priority(lane)
+            )
+        except Exception as e:
+            logger.error(f"Error creating invite link for group {group_id}: {e}")
+            return None
+        logger.info(f"Created invite link for group {group_id} for user {user_id}")
+        return invite_link.invite_link
+
+    links = await asyncio.gather(*(create(group_id) for group_id in groups))
+    return dict(zip(groups, links))
+
+def format_invite_links(links: Dict[int, Optional[str]]) -> str:
+    """Format the created links as a list for a message"""
+    return "\n".join(f"- {link}" for link in links.values() if link)
+
+class InviteLinkRetryQueue:
+    """Retries invite links that could not be created and sends them in a follow-up message"""
+    _application: Optional[Application] = None
+    # User ID -> {"groups": [...], "attempts": ...}
+    _pending: Dict[str, Dict] = {}
+
+    @staticmethod
+    def start(application: Application):
+        """Resume retries left over from before a restart"""
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, failed invite links will not be retried.")
+            return
+        InviteLinkRetryQueue._application = application
+        InviteLinkRetryQueue._pending = JsonHandler.get_state(RETRY_STATE) or {}
+        if InviteLinkRetryQueue._pending:
+            InviteLinkRetryQueue._schedule(0)
+
+    @staticmethod
+    def _schedule(delay: float):
+        """Schedule the next retry, unless one is already scheduled"""
+        job_queue = InviteLinkRetryQueue._application.job_queue
+        if not job_queue.get_jobs_by_name(JOB_NAME):
+            job_queue.run_once(InviteLinkRetryQueue._run, when=delay, name=JOB_NAME)
+
+    @staticmethod
+    async def add(user_id: int, groups: List[int]):
+        """Queue the groups a user is still missing invite links for"""
+        if InviteLinkRetryQueue._application is None:
+            return
+        entry = InviteLinkRetryQueue._pending.setdefault(str(user_id), {"groups": [], "attempts": 0})
+        entry["groups"] = sorted(set(entry["groups"]) | set(groups))
+        await JsonHandler.asave_state(RETRY_STATE, copy.deepcopy(InviteLinkRetryQueue._pending))
+        InviteLinkRetryQueue._schedule(INVITE_LINK_RETRY_DELAY)
+
+    @staticmethod
+    async def _run(context: ContextTypes.DEFAULT_TYPE):
+        """Retry all queued users once and schedule the next retry if any are left"""
+        pending = InviteLinkRetryQueue._pending
+        try:
+            await asyncio.gather(*(
+                InviteLinkRetryQueue._retry(context.bot, user_id) for user_id in list(pending)
+            ))
+        finally:
+            await JsonHandler.asave_state(RETRY_STATE, copy.deepcopy(pending))
+            if pending:
+                attempts = min(entry["attempts"] for entry in pending.values())
+                InviteLinkRetryQueue._schedule(min(INVITE_LINK_RETRY_DELAY * 2 ** attempts, INVITE_LINK_RETRY_MAX_DELAY))
+
+    @staticmethod
+    async def _retry(bot: ExtBot, user_id: str):
+        """Retry the missing links of one user and send the ones that were created"""
+        pending = InviteLinkRetryQueue._pending
+        entry = pending[user_id]
+        if not await SubscriptionManager.ais_subscription_active(int(user_id)):
+            logger.info(f"Dropping invite link retry for user {user_id}: subscription no longer active")
+            del pending[user_id]
+            return
+
+        links = await create_invite_links(bot, int(user_id), entry["groups"], PRIORITY_BACKGROUND)
+        created = {group_id: link for group_id, link in links.items() if link}
+        if created:
+            try:
+                await bot.send_message(
+                    chat_id=int(user_id),
+                    text=MESSAGES.get("invite_links_followup", DEFAULT_FOLLOWUP_MESSAGE).format(
+                        invite_links=format_invite_links(created)
+                    ),
+                    rate_limit_args=priority(PRIORITY_PAYMENT)
+                )
+            except Exception as e:
+                # The links are unused, so keep the groups queued and try again later
+                logger.error(f"Error sending follow-up invite links to user {user_id}: {e}")
+                created = {}
+
+        entry["groups"] = [group_id for group_id in entry["groups"] if group_id not in created]
+        entry["attempts"] += 1
+        if not entry["groups"]:
+            logger.info(f"Sent follow-up invite links to user {user_id}")
+            del pending[user_id]
+        elif entry["attempts"] >= INVITE_LINK_MAX_RETRIES:
+            logger.error(f"Giving up on invite links for groups {entry['groups']} for user {user_id}")
+            del pending[user_id]
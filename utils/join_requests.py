@@ -0,0 +1,80 @@
+import logging
+from typing import Dict, Optional
+
+from telegram.ext import Application, ContextTypes
+
+import config
+from config import GROUP_IDS
+from utils.json_handler import JsonHandler
+from utils.rate_limiter import PRIORITY_BACKGROUND, priority
+
+# "invite_links" gives every subscriber their own single-use links; "join_request"
+# hands out one shared link per group and approves join requests from subscribers
+INVITE_LINKS_MODE = "invite_links"
+JOIN_REQUEST_MODE = "join_request"
+INVITE_MODE = getattr(config, "INVITE_MODE", INVITE_LINKS_MODE)
+
+JOB_NAME = "create_join_request_links"
+# State entry holding the shared join-request link of each group
+LINKS_STATE = "join_request_links"
+LINK_NAME = "Subscribers"
+
+logger = logging.getLogger(__name__)
+
+def join_requests_enabled() -> bool:
+    """Check if access is granted by approving join requests"""
+    return INVITE_MODE == JOIN_REQUEST_MODE
+
+class JoinRequestLinks:
+    """One long-lived join-request invite link per group, shared by all subscribers"""
+    _application: Optional[Application] = None
+    # Group ID -> invite link
+    _links: Dict[int, str] = {}
+
+    @staticmethod
+    def start(application: Application):
+        """Load the shared links and create the missing ones in the background"""
+        if not join_requests_enabled():
+            return
+        JoinRequestLinks._application = application
+        saved = JsonHandler.get_state(LINKS_STATE) or {}
+        JoinRequestLinks._links = {int(group_id): link for group_id, link in saved.items()}
+        if application.job_queue is not None:
+            application.job_queue.run_once(JoinRequestLinks._create_job, when=0, name=JOB_NAME)
+
+    @staticmethod
+    async def _create_job(context: ContextTypes.DEFAULT_TYPE):
+        await JoinRequestLinks.create_missing()
+
+    @staticmethod
+    async def create_missing():
+        """Create a join-request link for every group that has none"""
+        if JoinRequestLinks._application is None:
+            return
+        bot = JoinRequestLinks._application.bot
+        created = False
+        for group_id in GROUP_IDS:
+            if group_id in JoinRequestLinks._links:
+                continue
+            try:
+                invite_link = await bot.create_chat_invite_link(
+                    chat_id=group_id,
+                    name=LINK_NAME,
+                    creates_join_request=True,
+                    rate_limit_args=priority(PRIORITY_BACKGROUND)
+                )
+            except Exception as e:
+                logger.error(f"Error creating join-request link for group {group_id}: {e}")
+                continue
+            JoinRequestLinks._links[group_id] = invite_link.invite_link
+            created = True
+            logger.info(f"Created join-request link for group {group_id}")
+        if created:
+            await JsonHandler.asave_state(
+                LINKS_STATE, {str(group_id): link for group_id, link in JoinRequestLinks._links.items()}
+            )
+
+    @staticmethod
+    def get(group_id: int) -> Optional[str]:
+        """Get the shared join-request link of a group, or None if it has none yet"""
+        return JoinRequestLinks._links.get(group_id)
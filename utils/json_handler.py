@@ -1,74 +1,652 @@
+import asyncio
+import bisect
+import contextlib
+import copy
+import functools
 import json
+import logging
 import os
-from typing import Dict, Any, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from datetime import datetime
 
+import config
 from config import DATA_DIR, USERS_FILE, SUBSCRIPTIONS_FILE, GROUPS_FILE
+from utils.durability import Durability
+from utils.sqlite_handler import SqliteHandler
+
+# "json" keeps data in DATA_DIR/*.json, "sqlite" in SQLITE_FILE
+STORAGE_BACKEND = getattr(config, "STORAGE_BACKEND", "json")
+# Append changed records to <file>.journal instead of rewriting the whole file,
+# folding the journal back into the file once it grows past JOURNAL_COMPACT_BYTES
+JSON_JOURNAL = getattr(config, "JSON_JOURNAL", False)
+JOURNAL_COMPACT_BYTES = getattr(config, "JOURNAL_COMPACT_BYTES", 1024 * 1024)
+JOURNAL_SUFFIX = ".journal"
+# Small named values kept by background jobs between restarts
+STATE_FILE = getattr(config, "STATE_FILE", f"{DATA_DIR}/state.json")
+# Last known membership status of users in the managed groups
+MEMBERSHIPS_FILE = getattr(config, "MEMBERSHIPS_FILE", f"{DATA_DIR}/memberships.json")
+# Payments reported by Robokassa, keyed by invoice ID
+PAYMENTS_FILE = getattr(config, "PAYMENTS_FILE", f"{DATA_DIR}/payments.json")
+# Side effects written together with the data they follow from, performed later by Outbox
+OUTBOX_FILE = getattr(config, "OUTBOX_FILE", f"{DATA_DIR}/outbox.json")
+# Threads that run storage calls for the async API, off the event loop
+STORAGE_THREADS = getattr(config, "STORAGE_THREADS", 4)
+
+logger = logging.getLogger(__name__)
+
+# Marks a record that did not exist before a transaction changed it
+_MISSING = object()
+
+def storage_method(func):
+    """Route a JsonHandler call to SqliteHandler when the SQLite backend is configured"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if STORAGE_BACKEND == "sqlite":
+            return getattr(SqliteHandler, func.__name__)(*args, **kwargs)
+        return func(*args, **kwargs)
+    return wrapper
 
 class JsonHandler:
+    # Parsed file contents kept in memory between calls, keyed by file path.
+    # Each entry holds the on-disk signature the data was read with, so a
+    # file edited outside the bot is re-read on the next access.
+    _cache: Dict[str, Tuple[Any, Dict]] = {}
+    _lock = threading.RLock()
+    _compacting: set = set()
+    # Index over subscriptions.json: user ID -> IDs of that user's subscriptions
+    _subscriptions_by_user: Dict[int, set] = {}
+    # Index over subscriptions.json: sorted (end_date, subscription ID) of active subscriptions
+    _expiry_index: List[Tuple[int, str]] = []
+    # Index over memberships.json: group ID -> keys of that group's membership records
+    _memberships_by_group: Dict[int, set] = {}
+    # Per-thread state of the transaction() block being run, if any
+    _local = threading.local()
+    _executor = ThreadPoolExecutor(max_workers=STORAGE_THREADS, thread_name_prefix="storage")
+
+    @staticmethod
+    async def run_async(func: Callable, *args) -> Any:
+        """Run a blocking storage call on the storage thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(JsonHandler._executor, func, *args)
+
     @staticmethod
     def ensure_data_dir():
         """Ensure data directory exists"""
         if not os.path.exists(DATA_DIR):
             os.makedirs(DATA_DIR)
 
+    @staticmethod
+    def _file_signature(file_path: str) -> Optional[Tuple[int, int]]:
+        """Get (mtime, size) of a file, or None if it does not exist"""
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def _data_signature(file_path: str) -> Any:
+        """Get the signature of everything a data file is loaded from"""
+        return (
+            JsonHandler._file_signature(file_path),
+            JsonHandler._file_signature(file_path + JOURNAL_SUFFIX),
+        )
+
+    @staticmethod
+    def _replay_journal(file_path: str, data: Dict) -> bool:
+        """Apply journaled record changes on top of the file contents.
+
+        Returns False if the journal had unreadable entries."""
+        journal_path = file_path + JOURNAL_SUFFIX
+        if not os.path.exists(journal_path):
+            return True
+        intact = True
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-append leaves a partial last line
+                    logger.warning(f"Skipping unreadable journal entry in {journal_path}")
+                    intact = False
+                    continue
+                if entry["value"] is None:
+                    # Deleted record
+                    data.pop(entry["key"], None)
+                else:
+                    data[entry["key"]] = entry["value"]
+        return intact
+
+    @staticmethod
+    def _load_cached(file_path: str) -> Dict:
+        """Get the cached contents of a JSON file, re-reading it only if it changed on disk"""
+        with JsonHandler._lock:
+            signature = JsonHandler._data_signature(file_path)
+            cached = JsonHandler._cache.get(file_path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+
+            data = {}
+            if os.path.exists(file_path):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            # Replayed even with journaling off, so switching it off loses nothing
+            intact = JsonHandler._replay_journal(file_path, data)
+            JsonHandler._cache[file_path] = (signature, data)
+            JsonHandler._rebuild_indexes(file_path, data)
+            if not intact:
+                # Fold it in now so new entries are not appended after a partial line
+                JsonHandler._flush_file(file_path)
+            return data
+
+    @staticmethod
+    def _rebuild_indexes(file_path: str, data: Dict):
+        """Rebuild the in-memory indexes over a data file"""
+        if file_path == MEMBERSHIPS_FILE:
+            memberships_by_group = {}
+            for key, membership in data.items():
+                memberships_by_group.setdefault(int(membership["group_id"]), set()).add(key)
+            JsonHandler._memberships_by_group = memberships_by_group
+            return
+        if file_path != SUBSCRIPTIONS_FILE:
+            return
+        subscriptions_by_user = {}
+        expiry_index = []
+        for subscription_id, subscription in data.items():
+            subscriptions_by_user.setdefault(int(subscription["user_id"]), set()).add(subscription_id)
+            if JsonHandler._is_expiry_indexed(subscription):
+                expiry_index.append((subscription["end_date"], subscription_id))
+        expiry_index.sort()
+        JsonHandler._subscriptions_by_user = subscriptions_by_user
+        JsonHandler._expiry_index = expiry_index
+
+    @staticmethod
+    def _is_expiry_indexed(subscription: Dict) -> bool:
+        """Check if a subscription belongs in the expiry index"""
+        return subscription.get("status") == "active" and subscription.get("end_date") is not None
+
+    @staticmethod
+    def _update_indexes(file_path: str, key: str, old_record: Optional[Dict], new_record: Optional[Dict]):
+        """Move a changed record within the in-memory indexes"""
+        if file_path == MEMBERSHIPS_FILE:
+            if old_record is None and new_record is not None:
+                JsonHandler._memberships_by_group.setdefault(int(new_record["group_id"]), set()).add(key)
+            elif old_record is not None and new_record is None:
+                JsonHandler._memberships_by_group.get(int(old_record["group_id"]), set()).discard(key)
+            return
+        if file_path != SUBSCRIPTIONS_FILE:
+            return
+        if old_record is not None:
+            user_id = int(old_record["user_id"])
+            subscription_ids = JsonHandler._subscriptions_by_user.get(user_id, set())
+            subscription_ids.discard(key)
+            if not subscription_ids:
+                JsonHandler._subscriptions_by_user.pop(user_id, None)
+            if JsonHandler._is_expiry_indexed(old_record):
+                entry = (old_record["end_date"], key)
+                position = bisect.bisect_left(JsonHandler._expiry_index, entry)
+                if position < len(JsonHandler._expiry_index) and JsonHandler._expiry_index[position] == entry:
+                    del JsonHandler._expiry_index[position]
+        if new_record is not None:
+            JsonHandler._subscriptions_by_user.setdefault(int(new_record["user_id"]), set()).add(key)
+            if JsonHandler._is_expiry_indexed(new_record):
+                bisect.insort(JsonHandler._expiry_index, (new_record["end_date"], key))
+
     @staticmethod
     def load_data(file_path: str) -> Dict:
         """Load data from JSON file"""
         JsonHandler.ensure_data_dir()
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
+        return copy.deepcopy(JsonHandler._load_cached(file_path))
 
     @staticmethod
     def save_data(file_path: str, data: Dict):
-        """Save data to JSON file"""
+        """Save data to JSON file and keep it as the cached contents"""
+        Durability.wait(JsonHandler._save_data(file_path, data))
+
+    @staticmethod
+    def _save_data(file_path: str, data: Dict) -> int:
+        """Save data to JSON file, returning the ticket to wait on once the lock is released"""
+        JsonHandler.ensure_data_dir()
+        with JsonHandler._lock:
+            cached = JsonHandler._cache.get(file_path)
+            if cached is None or cached[1] is not data:
+                JsonHandler._rebuild_indexes(file_path, data)
+            # Until the write is flushed the file on disk still matches the old
+            # signature, so reads keep hitting the new cached data
+            JsonHandler._cache[file_path] = (JsonHandler._data_signature(file_path), data)
+            return Durability.commit(file_path, lambda: JsonHandler._flush_file(file_path))
+
+    @staticmethod
+    def _flush_file(file_path: str):
+        """Write the cached contents of a data file to disk and drop its journal"""
+        with JsonHandler._lock:
+            cached = JsonHandler._cache.get(file_path)
+            if cached is None:
+                return
+            data = cached[1]
+            Durability.write_atomic(file_path, json.dumps(data, indent=4, ensure_ascii=False))
+            if os.path.exists(file_path + JOURNAL_SUFFIX):
+                os.remove(file_path + JOURNAL_SUFFIX)
+            JsonHandler._cache[file_path] = (JsonHandler._data_signature(file_path), data)
+
+    @staticmethod
+    def _get_record(file_path: str, key: str) -> Optional[Dict]:
+        """Get a copy of a single record from a cached JSON file"""
+        JsonHandler.ensure_data_dir()
+        with JsonHandler._lock:
+            record = JsonHandler._load_cached(file_path).get(key)
+            return copy.deepcopy(record) if record is not None else None
+
+    @staticmethod
+    def _save_record(file_path: str, key: str, record: Dict):
+        """Write a single record through the cache to its JSON file or journal"""
+        JsonHandler.ensure_data_dir()
+        ticket = 0
+        with JsonHandler._lock:
+            data = JsonHandler._load_cached(file_path)
+            transaction = getattr(JsonHandler._local, "transaction", None)
+            if transaction is not None:
+                undo = transaction["undo"].setdefault(file_path, {})
+                undo.setdefault(key, data.get(key, _MISSING))
+            JsonHandler._update_indexes(file_path, key, data.get(key), record)
+            data[key] = copy.deepcopy(record)
+            if transaction is not None:
+                transaction["changes"].setdefault(file_path, {})[key] = data[key]
+            else:
+                ticket = JsonHandler._write_records(file_path, {key: data[key]})
+        Durability.wait(ticket)
+
+    @staticmethod
+    def _delete_record(file_path: str, key: str):
+        """Remove a single record through the cache from its JSON file or journal"""
         JsonHandler.ensure_data_dir()
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        ticket = 0
+        with JsonHandler._lock:
+            data = JsonHandler._load_cached(file_path)
+            if key not in data:
+                return
+            transaction = getattr(JsonHandler._local, "transaction", None)
+            if transaction is not None:
+                undo = transaction["undo"].setdefault(file_path, {})
+                undo.setdefault(key, data[key])
+            JsonHandler._update_indexes(file_path, key, data[key], None)
+            del data[key]
+            if transaction is not None:
+                transaction["changes"].setdefault(file_path, {})[key] = None
+            else:
+                ticket = JsonHandler._write_records(file_path, {key: None})
+        Durability.wait(ticket)
+
+    @staticmethod
+    def _write_records(file_path: str, records: Dict[str, Optional[Dict]]) -> int:
+        """Persist records already applied to the cached contents of a data file.
+
+        A record of None was deleted and is journaled as such. Returns the
+        Durability ticket to wait on once the lock is released."""
+        if not JSON_JOURNAL:
+            return JsonHandler._save_data(file_path, JsonHandler._cache[file_path][1])
+
+        journal_path = file_path + JOURNAL_SUFFIX
+        lines = "".join(
+            json.dumps({"key": key, "value": record}, ensure_ascii=False) + "\n"
+            for key, record in records.items()
+        )
+        with open(journal_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+        JsonHandler._cache[file_path] = (JsonHandler._data_signature(file_path), JsonHandler._cache[file_path][1])
+        ticket = 0
+        if Durability.should_sync():
+            ticket = Durability.commit(journal_path, lambda: Durability.sync_file(journal_path))
+        if os.path.getsize(journal_path) >= JOURNAL_COMPACT_BYTES:
+            JsonHandler._start_compaction(file_path)
+        return ticket
+
+    @staticmethod
+    @storage_method
+    @contextlib.contextmanager
+    def transaction():
+        """Group storage calls into one unit of work.
+
+        Reads inside the block see its own writes, other threads wait until it
+        ends, and changes are written with one flush per file on success or
+        discarded if the block raises."""
+        if getattr(JsonHandler._local, "transaction", None) is not None:
+            # Nested blocks join the outer transaction
+            yield
+            return
+
+        ticket = 0
+        with JsonHandler._lock:
+            transaction = {"undo": {}, "changes": {}}
+            JsonHandler._local.transaction = transaction
+            try:
+                yield
+            except BaseException:
+                for file_path, undo in transaction["undo"].items():
+                    data = JsonHandler._cache[file_path][1]
+                    for key, old_record in undo.items():
+                        restored = None if old_record is _MISSING else old_record
+                        JsonHandler._update_indexes(file_path, key, data.get(key), restored)
+                        if restored is None:
+                            data.pop(key, None)
+                        else:
+                            data[key] = restored
+                raise
+            finally:
+                JsonHandler._local.transaction = None
+
+            for file_path, records in transaction["changes"].items():
+                ticket = max(ticket, JsonHandler._write_records(file_path, records))
+        # Waited for outside the lock, which flushing the batch takes
+        Durability.wait(ticket)
+
+    @staticmethod
+    def _start_compaction(file_path: str):
+        """Fold a journal into its data file on a background thread"""
+        if file_path in JsonHandler._compacting:
+            return
+        JsonHandler._compacting.add(file_path)
+        threading.Thread(
+            target=JsonHandler.compact,
+            args=(file_path,),
+            name=f"compact-{os.path.basename(file_path)}",
+            daemon=True
+        ).start()
+
+    @staticmethod
+    def compact(file_path: str):
+        """Write the current data as a new snapshot and drop the journal"""
+        try:
+            with JsonHandler._lock:
+                JsonHandler._load_cached(file_path)
+                JsonHandler._flush_file(file_path)
+            logger.info(f"Compacted journal for {file_path}")
+        except Exception as e:
+            logger.error(f"Failed to compact journal for {file_path}: {e}")
+        finally:
+            JsonHandler._compacting.discard(file_path)
 
     @staticmethod
+    @storage_method
     def get_user(user_id: int) -> Optional[Dict]:
         """Get user data"""
-        users = JsonHandler.load_data(USERS_FILE)
-        return users.get(str(user_id))
+        return JsonHandler._get_record(USERS_FILE, str(user_id))
 
     @staticmethod
+    @storage_method
     def save_user(user_id: int, user_data: Dict):
         """Save user data"""
-        users = JsonHandler.load_data(USERS_FILE)
-        users[str(user_id)] = user_data
-        JsonHandler.save_data(USERS_FILE, users)
+        JsonHandler._save_record(USERS_FILE, str(user_id), user_data)
+
+    @staticmethod
+    @storage_method
+    def get_all_users() -> Dict[str, Dict]:
+        """Get all users keyed by user ID"""
+        return JsonHandler.load_data(USERS_FILE)
 
     @staticmethod
+    @storage_method
     def get_subscription(subscription_id: str) -> Optional[Dict]:
         """Get subscription data"""
-        subscriptions = JsonHandler.load_data(SUBSCRIPTIONS_FILE)
-        return subscriptions.get(subscription_id)
+        return JsonHandler._get_record(SUBSCRIPTIONS_FILE, subscription_id)
 
     @staticmethod
+    @storage_method
     def save_subscription(subscription_id: str, subscription_data: Dict):
         """Save subscription data"""
-        subscriptions = JsonHandler.load_data(SUBSCRIPTIONS_FILE)
-        subscriptions[subscription_id] = subscription_data
-        JsonHandler.save_data(SUBSCRIPTIONS_FILE, subscriptions)
+        JsonHandler._save_record(SUBSCRIPTIONS_FILE, subscription_id, subscription_data)
+
+    @staticmethod
+    @storage_method
+    def get_all_subscriptions() -> Dict[str, Dict]:
+        """Get all subscriptions keyed by subscription ID"""
+        return JsonHandler.load_data(SUBSCRIPTIONS_FILE)
+
+    @staticmethod
+    @storage_method
+    def get_user_subscriptions(user_id: int) -> Dict[str, Dict]:
+        """Get all subscriptions of a user keyed by subscription ID, oldest first"""
+        with JsonHandler._lock:
+            subscriptions = JsonHandler._load_cached(SUBSCRIPTIONS_FILE)
+            subscription_ids = sorted(JsonHandler._subscriptions_by_user.get(int(user_id), ()))
+            return {
+                subscription_id: copy.deepcopy(subscriptions[subscription_id])
+                for subscription_id in subscription_ids
+            }
+
+    @staticmethod
+    @storage_method
+    def get_expiring_subscriptions(start: int, end: int, limit: Optional[int] = None) -> Dict[str, Dict]:
+        """Get up to limit active subscriptions with start <= end_date < end, soonest first"""
+        with JsonHandler._lock:
+            subscriptions = JsonHandler._load_cached(SUBSCRIPTIONS_FILE)
+            index = JsonHandler._expiry_index
+            low = bisect.bisect_left(index, (start, ""))
+            high = bisect.bisect_left(index, (end, ""))
+            if limit is not None:
+                high = min(high, low + limit)
+            return {
+                subscription_id: copy.deepcopy(subscriptions[subscription_id])
+                for _, subscription_id in index[low:high]
+            }
+
+    @staticmethod
+    @storage_method
+    def get_next_expiring_subscriptions(limit: int) -> Dict[str, Dict]:
+        """Get up to limit active subscriptions with the earliest end_date, soonest first"""
+        with JsonHandler._lock:
+            subscriptions = JsonHandler._load_cached(SUBSCRIPTIONS_FILE)
+            return {
+                subscription_id: copy.deepcopy(subscriptions[subscription_id])
+                for _, subscription_id in JsonHandler._expiry_index[:limit]
+            }
 
     @staticmethod
+    @storage_method
     def get_group(group_id: int) -> Optional[Dict]:
         """Get group data"""
-        groups = JsonHandler.load_data(GROUPS_FILE)
-        return groups.get(str(group_id))
+        return JsonHandler._get_record(GROUPS_FILE, str(group_id))
 
     @staticmethod
+    @storage_method
     def save_group(group_id: int, group_data: Dict):
         """Save group data"""
-        groups = JsonHandler.load_data(GROUPS_FILE)
-        groups[str(group_id)] = group_data
-        JsonHandler.save_data(GROUPS_FILE, groups)
+        JsonHandler._save_record(GROUPS_FILE, str(group_id), group_data)
+
+    @staticmethod
+    @storage_method
+    def get_membership(group_id: int, user_id: int) -> Optional[Dict]:
+        """Get the last known membership of a user in a group"""
+        return JsonHandler._get_record(MEMBERSHIPS_FILE, f"{group_id}:{user_id}")
+
+    @staticmethod
+    @storage_method
+    def save_membership(group_id: int, user_id: int, membership: Dict):
+        """Save the membership of a user in a group"""
+        JsonHandler._save_record(MEMBERSHIPS_FILE, f"{group_id}:{user_id}", {
+            **membership, "group_id": int(group_id), "user_id": int(user_id)
+        })
+
+    @staticmethod
+    @storage_method
+    def get_group_memberships(group_id: int) -> Dict[str, Dict]:
+        """Get the last known memberships of all users seen in a group, keyed by user ID"""
+        JsonHandler.ensure_data_dir()
+        with JsonHandler._lock:
+            data = JsonHandler._load_cached(MEMBERSHIPS_FILE)
+            return {
+                str(data[key]["user_id"]): copy.deepcopy(data[key])
+                for key in JsonHandler._memberships_by_group.get(int(group_id), ())
+            }
+
+    @staticmethod
+    @storage_method
+    def get_payment(inv_id: int) -> Optional[Dict]:
+        """Get payment data"""
+        return JsonHandler._get_record(PAYMENTS_FILE, str(inv_id))
+
+    @staticmethod
+    @storage_method
+    def save_payment(inv_id: int, payment_data: Dict):
+        """Save payment data"""
+        JsonHandler._save_record(PAYMENTS_FILE, str(inv_id), payment_data)
+
+    @staticmethod
+    @storage_method
+    def get_outbox_entry(entry_id: str) -> Optional[Dict]:
+        """Get outbox entry data"""
+        return JsonHandler._get_record(OUTBOX_FILE, entry_id)
+
+    @staticmethod
+    @storage_method
+    def save_outbox_entry(entry_id: str, entry_data: Dict):
+        """Save outbox entry data"""
+        JsonHandler._save_record(OUTBOX_FILE, entry_id, entry_data)
+
+    @staticmethod
+    @storage_method
+    def delete_outbox_entry(entry_id: str):
+        """Delete an outbox entry"""
+        JsonHandler._delete_record(OUTBOX_FILE, entry_id)
+
+    @staticmethod
+    @storage_method
+    def get_outbox_entries(status: str) -> Dict[str, Dict]:
+        """Get all outbox entries with a status keyed by entry ID"""
+        JsonHandler.ensure_data_dir()
+        with JsonHandler._lock:
+            return {
+                entry_id: copy.deepcopy(entry)
+                for entry_id, entry in JsonHandler._load_cached(OUTBOX_FILE).items()
+                if entry.get("status") == status
+            }
+
+    @staticmethod
+    async def aget_user(user_id: int) -> Optional[Dict]:
+        """Get user data without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_user, user_id)
+
+    @staticmethod
+    async def asave_user(user_id: int, user_data: Dict):
+        """Save user data without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_user, user_id, user_data)
+
+    @staticmethod
+    async def aget_all_users() -> Dict[str, Dict]:
+        """Get all users without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_all_users)
+
+    @staticmethod
+    async def aget_subscription(subscription_id: str) -> Optional[Dict]:
+        """Get subscription data without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_subscription, subscription_id)
+
+    @staticmethod
+    async def asave_subscription(subscription_id: str, subscription_data: Dict):
+        """Save subscription data without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_subscription, subscription_id, subscription_data)
+
+    @staticmethod
+    async def aget_all_subscriptions() -> Dict[str, Dict]:
+        """Get all subscriptions without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_all_subscriptions)
+
+    @staticmethod
+    async def aget_user_subscriptions(user_id: int) -> Dict[str, Dict]:
+        """Get all subscriptions of a user without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_user_subscriptions, user_id)
+
+    @staticmethod
+    async def aget_expiring_subscriptions(start: int, end: int, limit: Optional[int] = None) -> Dict[str, Dict]:
+        """Get expiring subscriptions without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_expiring_subscriptions, start, end, limit)
+
+    @staticmethod
+    async def aget_next_expiring_subscriptions(limit: int) -> Dict[str, Dict]:
+        """Get the next expiring subscriptions without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_next_expiring_subscriptions, limit)
+
+    @staticmethod
+    async def aget_group(group_id: int) -> Optional[Dict]:
+        """Get group data without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_group, group_id)
+
+    @staticmethod
+    async def asave_group(group_id: int, group_data: Dict):
+        """Save group data without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_group, group_id, group_data)
+
+    @staticmethod
+    async def aget_payment(inv_id: int) -> Optional[Dict]:
+        """Get payment data without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_payment, inv_id)
+
+    @staticmethod
+    async def asave_payment(inv_id: int, payment_data: Dict):
+        """Save payment data without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_payment, inv_id, payment_data)
+
+    @staticmethod
+    async def aget_outbox_entry(entry_id: str) -> Optional[Dict]:
+        """Get outbox entry data without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_outbox_entry, entry_id)
+
+    @staticmethod
+    async def asave_outbox_entry(entry_id: str, entry_data: Dict):
+        """Save outbox entry data without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_outbox_entry, entry_id, entry_data)
+
+    @staticmethod
+    async def adelete_outbox_entry(entry_id: str):
+        """Delete an outbox entry without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.delete_outbox_entry, entry_id)
+
+    @staticmethod
+    async def aget_outbox_entries(status: str) -> Dict[str, Dict]:
+        """Get all outbox entries with a status without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_outbox_entries, status)
+
+    @staticmethod
+    async def aget_membership(group_id: int, user_id: int) -> Optional[Dict]:
+        """Get the last known membership of a user in a group without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_membership, group_id, user_id)
+
+    @staticmethod
+    async def asave_membership(group_id: int, user_id: int, membership: Dict):
+        """Save the membership of a user in a group without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_membership, group_id, user_id, membership)
+
+    @staticmethod
+    async def aget_group_memberships(group_id: int) -> Dict[str, Dict]:
+        """Get the last known memberships in a group without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_group_memberships, group_id)
+
+    @staticmethod
+    @storage_method
+    def get_state(name: str) -> Any:
+        """Get a stored state value"""
+        return JsonHandler._get_record(STATE_FILE, name)
+
+    @staticmethod
+    @storage_method
+    def save_state(name: str, value: Any):
+        """Save a state value"""
+        JsonHandler._save_record(STATE_FILE, name, value)
+
+    @staticmethod
+    async def aget_state(name: str) -> Any:
+        """Get a stored state value without blocking the event loop"""
+        return await JsonHandler.run_async(JsonHandler.get_state, name)
+
+    @staticmethod
+    async def asave_state(name: str, value: Any):
+        """Save a state value without blocking the event loop"""
+        await JsonHandler.run_async(JsonHandler.save_state, name, value)
 
     @staticmethod
     def create_subscription_id(user_id: int) -> str:
         """Create unique subscription ID"""
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        return f"sub_{user_id}_{timestamp}" 
\ No newline at end of file
+        return f"sub_{user_id}_{timestamp}"
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import random
+import time
+import uuid
+from typing import Any, Callable, Coroutine, Dict, Optional, Set
+
+from telegram.ext import Application, ContextTypes, ExtBot
+
+import config
+from utils.json_handler import JsonHandler
+
+# Entries performed at the same time
+OUTBOX_WORKERS = getattr(config, "OUTBOX_WORKERS", 4)
+# Seconds between checks for entries due for a retry
+OUTBOX_POLL_INTERVAL = getattr(config, "OUTBOX_POLL_INTERVAL", 10)
+# Backoff before the first retry of a failed entry, doubled after each failure up to the maximum
+OUTBOX_RETRY_BASE_DELAY = getattr(config, "OUTBOX_RETRY_BASE_DELAY", 15)
+OUTBOX_RETRY_MAX_DELAY = getattr(config, "OUTBOX_RETRY_MAX_DELAY", 30 * 60)
+# Attempts before an entry is marked dead and left alone
+OUTBOX_MAX_ATTEMPTS = getattr(config, "OUTBOX_MAX_ATTEMPTS", 10)
+
+JOB_NAME = "drain_outbox"
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[ExtBot, str, Dict[str, Any]], Coroutine[Any, Any, None]]
+
+class Outbox:
+    """Side effects stored in the same transaction as the data they follow from.
+
+    Entries are added with add() inside JsonHandler.transaction(), so they are
+    written if and only if the data is. Workers then perform them with the
+    handler registered for their kind, retrying with backoff until they succeed.
+    Performed entries are deleted; entries given up on are kept as "dead"."""
+    _application: Optional[Application] = None
+    _handlers: Dict[str, Handler] = {}
+    _queue: Optional[asyncio.Queue] = None
+    _workers: list = []
+    # Entry IDs queued or being performed
+    _in_flight: Set[str] = set()
+
+    @staticmethod
+    def register(kind: str, handler: Handler):
+        """Perform entries of a kind with handler(bot, entry_id, payload).
+
+        Handlers are retried, so a handler with steps that must not be repeated
+        records their results in the payload and saves it with checkpoint()."""
+        Outbox._handlers[kind] = handler
+
+    @staticmethod
+    def add(kind: str, payload: Dict[str, Any]) -> str:
+        """Store a pending entry, normally inside a transaction. Returns its ID."""
+        entry_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+        JsonHandler.save_outbox_entry(entry_id, {
+            "kind": kind,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt": 0,
+            "created_at": int(time.time()),
+        })
+        return entry_id
+
+    @staticmethod
+    async def checkpoint(entry_id: str, payload: Dict[str, Any]):
+        """Save the progress a handler recorded in the payload of its entry"""
+        entry = await JsonHandler.aget_outbox_entry(entry_id)
+        if entry is not None:
+            entry["payload"] = payload
+            await JsonHandler.asave_outbox_entry(entry_id, entry)
+
+    @staticmethod
+    def start(application: Application):
+        """Perform pending entries, including those left before a restart, on a repeating job"""
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, failed outbox entries will not be retried.")
+        Outbox._application = application
+        if application.job_queue is not None:
+            application.job_queue.run_repeating(
+                Outbox._poll, interval=OUTBOX_POLL_INTERVAL, first=0, name=JOB_NAME
+            )
+
+    @staticmethod
+    def _ensure_workers():
+        if Outbox._queue is None:
+            Outbox._queue = asyncio.Queue()
+            Outbox._workers = [asyncio.create_task(Outbox._worker()) for _ in range(OUTBOX_WORKERS)]
+
+    @staticmethod
+    def wake(entry_id: str):
+        """Perform a just committed entry now instead of at the next poll"""
+        if Outbox._application is None or entry_id in Outbox._in_flight:
+            return
+        Outbox._ensure_workers()
+        Outbox._in_flight.add(entry_id)
+        Outbox._queue.put_nowait(entry_id)
+
+    @staticmethod
+    async def _poll(context: ContextTypes.DEFAULT_TYPE):
+        """Queue the pending entries that are due"""
+        now = time.time()
+        for entry_id, entry in (await JsonHandler.aget_outbox_entries("pending")).items():
+            if entry["next_attempt"] <= now:
+                Outbox.wake(entry_id)
+
+    @staticmethod
+    async def _worker():
+        while True:
+            entry_id = await Outbox._queue.get()
+            try:
+                await Outbox._perform(entry_id)
+            except Exception as e:
+                logger.error(f"Outbox entry {entry_id} could not be processed: {e}")
+            finally:
+                Outbox._in_flight.discard(entry_id)
+                Outbox._queue.task_done()
+
+    @staticmethod
+    async def _perform(entry_id: str):
+        """Perform an entry and record the outcome"""
+        entry = await JsonHandler.aget_outbox_entry(entry_id)
+        if entry is None or entry["status"] != "pending":
+            return
+        handler = Outbox._handlers.get(entry["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"No outbox handler for {entry['kind']}")
+            await handler(Outbox._application.bot, entry_id, entry["payload"])
+        except Exception as e:
+            entry["attempts"] += 1
+            entry["last_error"] = str(e)
+            if entry["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                entry["status"] = "dead"
+                logger.error(f"Giving up on outbox entry {entry_id} ({entry['kind']}) after {entry['attempts']} attempts: {e}")
+            else:
+                delay = min(OUTBOX_RETRY_BASE_DELAY * 2 ** (entry["attempts"] - 1), OUTBOX_RETRY_MAX_DELAY)
+                entry["next_attempt"] = time.time() + delay * random.uniform(0.5, 1.5)
+                logger.warning(f"Outbox entry {entry_id} ({entry['kind']}) failed, retrying later: {e}")
+        else:
+            await JsonHandler.adelete_outbox_entry(entry_id)
+            return
+        await JsonHandler.asave_outbox_entry(entry_id, entry)
+
+    @staticmethod
+    async def stop(application: Application):
+        """Stop the workers. Entries not yet performed stay pending for the next start."""
+        for worker in Outbox._workers:
+            worker.cancel()
+        await asyncio.gather(*Outbox._workers, return_exceptions=True)
+        Outbox._workers = []
+        Outbox._queue = None
+        Outbox._in_flight.clear()
+        Outbox._application = None
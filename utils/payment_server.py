@@ -0,0 +1,159 @@
+import html
+import logging
+import time
+from typing import Dict, Optional
+
+from aiohttp import web
+from telegram.ext import Application
+
+import config
+from config import MESSAGES, SUBSCRIPTION_TYPES
+from utils import robokassa
+from utils.activation import agrant_subscription
+from utils.idempotency import DONE, IdempotencyStore
+from utils.json_handler import JsonHandler
+
+# Address the Robokassa callback server listens on
+PAYMENT_SERVER_HOST = getattr(config, "PAYMENT_SERVER_HOST", "0.0.0.0")
+PAYMENT_SERVER_PORT = getattr(config, "PAYMENT_SERVER_PORT", 8080)
+# Seconds an invoice ID is remembered, so repeated ResultURL callbacks are answered from memory
+INVOICE_IDEMPOTENCY_TTL = getattr(config, "INVOICE_IDEMPOTENCY_TTL", 24 * 60 * 60)
+
+# Paths to enter as ResultURL, SuccessURL and FailURL in the Robokassa merchant settings
+RESULT_PATH = "/robokassa/result"
+SUCCESS_PATH = "/robokassa/success"
+FAIL_PATH = "/robokassa/fail"
+
+logger = logging.getLogger(__name__)
+
+class PaymentServer:
+    """HTTP server for Robokassa callbacks, running in the bot's event loop.
+
+    A ResultURL callback is verified and the invoice, its subscription and the
+    delivery of the invite links are written in one transaction before it is
+    acknowledged; the Outbox then sends the links."""
+    _runner: Optional[web.AppRunner] = None
+    # Invoice IDs already recorded or being recorded
+    _invoices = IdempotencyStore(INVOICE_IDEMPOTENCY_TTL)
+
+    @staticmethod
+    async def start(application: Application):
+        """Start the server"""
+        if not robokassa.is_configured():
+            logger.info("Robokassa is not configured, payment server not started.")
+            return
+        # Have invoice IDs ready before the first /subscribe
+        await robokassa.InvoiceIds.reserve()
+
+        PaymentServer._runner = web.AppRunner(PaymentServer.build_app())
+        await PaymentServer._runner.setup()
+        await web.TCPSite(PaymentServer._runner, PAYMENT_SERVER_HOST, PAYMENT_SERVER_PORT).start()
+        logger.info(f"Payment server listening on {PAYMENT_SERVER_HOST}:{PAYMENT_SERVER_PORT}")
+
+    @staticmethod
+    async def stop(application: Application):
+        """Stop the server"""
+        if PaymentServer._runner is not None:
+            await PaymentServer._runner.cleanup()
+            PaymentServer._runner = None
+
+    @staticmethod
+    def build_app() -> web.Application:
+        """Build the web application with the callback routes"""
+        app = web.Application()
+        for path, handler in (
+            (RESULT_PATH, PaymentServer.handle_result),
+            (SUCCESS_PATH, PaymentServer.handle_success),
+            (FAIL_PATH, PaymentServer.handle_fail),
+        ):
+            app.router.add_get(path, handler)
+            app.router.add_post(path, handler)
+        return app
+
+    @staticmethod
+    async def _params(request: web.Request) -> Dict[str, str]:
+        """Get the callback parameters, sent either in the query or as a form"""
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        return params
+
+    @staticmethod
+    async def handle_result(request: web.Request) -> web.Response:
+        """Record a paid invoice and acknowledge it with OK<InvId>"""
+        params = await PaymentServer._params(request)
+        if not robokassa.verify_result(params):
+            logger.warning(f"Rejected Robokassa result with a bad signature for invoice {params.get('InvId')}")
+            return web.Response(status=400, text="bad sign")
+        try:
+            inv_id = int(params["InvId"])
+            user_id = int(params[robokassa.SHP_USER])
+            subscription_type = params[robokassa.SHP_PLAN]
+            out_sum = float(params["OutSum"])
+        except (KeyError, ValueError):
+            logger.error(f"Robokassa result is missing parameters: {params}")
+            return web.Response(status=400, text="bad request")
+
+        # Robokassa repeats the callback until it gets OK, so most repeats are answered here
+        seen = PaymentServer._invoices.begin(inv_id)
+        if seen == DONE:
+            return web.Response(text=f"OK{inv_id}")
+        if seen is not None:
+            # Not OK yet: if the first delivery fails, Robokassa must try again
+            return web.Response(status=409, text="in progress")
+        try:
+            await PaymentServer._record_payment(inv_id, user_id, subscription_type, out_sum)
+        except Exception:
+            PaymentServer._invoices.abort(inv_id)
+            raise
+        PaymentServer._invoices.finish(inv_id)
+        return web.Response(text=f"OK{inv_id}")
+
+    @staticmethod
+    async def _record_payment(inv_id: int, user_id: int, subscription_type: str, out_sum: float):
+        """Store a paid invoice and activate its subscription, unless it was stored before"""
+        if await JsonHandler.aget_payment(inv_id) is not None:
+            return
+        payment = {
+            "user_id": user_id,
+            "subscription_type": subscription_type,
+            "out_sum": out_sum,
+            "status": "paid",
+            "paid_at": int(time.time()),
+        }
+        logger.info(f"Received payment for invoice {inv_id} from user {user_id}")
+        plan = SUBSCRIPTION_TYPES.get(subscription_type)
+        if plan is None or out_sum < plan["price"]:
+            logger.error(f"Invoice {inv_id} paid {out_sum} for unknown or pricier plan {subscription_type}")
+            payment["status"] = "rejected"
+            await JsonHandler.asave_payment(inv_id, payment)
+            return
+        await PaymentServer._activate(inv_id, payment)
+
+    @staticmethod
+    async def handle_success(request: web.Request) -> web.Response:
+        """Show the user a page after a successful payment"""
+        params = await PaymentServer._params(request)
+        if not robokassa.verify_success(params):
+            return web.Response(status=400, text="bad sign")
+        return PaymentServer._page(MESSAGES["payment_success"])
+
+    @staticmethod
+    async def handle_fail(request: web.Request) -> web.Response:
+        """Show the user a page after a cancelled payment"""
+        return PaymentServer._page(MESSAGES["payment_cancelled"])
+
+    @staticmethod
+    def _page(text: str) -> web.Response:
+        return web.Response(
+            text=f"<html><head><meta charset=\"utf-8\"></head><body><p>{html.escape(text)}</p></body></html>",
+            content_type="text/html"
+        )
+
+    @staticmethod
+    async def _activate(inv_id: int, payment: Dict):
+        """Activate the subscription of a paid invoice, saving the invoice in the same transaction"""
+        subscription_id = await agrant_subscription(
+            payment["user_id"], payment["subscription_type"], inv_id, payment
+        )
+        logger.info(f"Activated subscription {subscription_id} for invoice {inv_id}")
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Coroutine, Deque, Dict, Optional, Set, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import config
+
+# Bot API calls per second across all chats
+TELEGRAM_GLOBAL_RATE = getattr(config, "TELEGRAM_GLOBAL_RATE", 30)
+# Messages per second to a single private chat and to a single group
+TELEGRAM_PRIVATE_CHAT_RATE = getattr(config, "TELEGRAM_PRIVATE_CHAT_RATE", 1.0)
+TELEGRAM_GROUP_CHAT_RATE = getattr(config, "TELEGRAM_GROUP_CHAT_RATE", 20 / 60)
+# Messages that may be sent to one chat back to back before its rate applies
+TELEGRAM_CHAT_BURST = getattr(config, "TELEGRAM_CHAT_BURST", 3)
+# Times a request is re-queued after a RetryAfter before the error is raised
+TELEGRAM_MAX_RETRIES = getattr(config, "TELEGRAM_MAX_RETRIES", 3)
+
+# Priority lanes: replies to users, calls that deliver what a user paid for, and
+# bulk work such as expiry sweeps. Each lane gets a share of the sending rate
+# proportional to its weight while it has requests waiting.
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_PAYMENT = "payment"
+PRIORITY_BACKGROUND = "background"
+TELEGRAM_LANE_WEIGHTS = getattr(config, "TELEGRAM_LANE_WEIGHTS", {
+    PRIORITY_INTERACTIVE: 6,
+    PRIORITY_PAYMENT: 3,
+    PRIORITY_BACKGROUND: 1,
+})
+
+# Endpoints that post into a chat and so count against that chat's own limit
+PER_CHAT_ENDPOINT_PREFIXES = ("send", "copyMessage", "forwardMessage", "editMessage")
+# Idle per-chat buckets kept before full ones are dropped
+MAX_CHAT_BUCKETS = 10000
+
+logger = logging.getLogger(__name__)
+
+def priority(lane: str) -> Dict[str, Any]:
+    """Build the rate_limit_args that send an ExtBot call through a priority lane"""
+    return {"priority": lane}
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Get seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """Take a token"""
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        """Check if the bucket has been idle long enough to refill completely"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+@dataclass
+class QueuedRequest:
+    """A Bot API call waiting for its turn"""
+    callback: Callable[..., Coroutine[Any, Any, Any]]
+    args: Any
+    kwargs: Dict[str, Any]
+    endpoint: str
+    chat_id: Optional[Union[int, str]]
+    future: asyncio.Future
+    lane: str = PRIORITY_INTERACTIVE
+    attempts: int = 0
+
+class TelegramRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Queues Bot API calls so they stay within the global and per-chat limits.
+
+    A request is sent once both the global bucket and, for messages, its chat's
+    bucket have a token. Requests to a chat that is at its limit do not hold up
+    requests to other chats. Requests wait in priority lanes, chosen with
+    rate_limit_args=priority(...) and interactive by default; when several lanes
+    have a request ready they are served by smooth weighted round robin. A
+    RetryAfter pauses all sending for the requested time and puts the request
+    back at the head of its lane."""
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        private_chat_rate: float = TELEGRAM_PRIVATE_CHAT_RATE,
+        group_chat_rate: float = TELEGRAM_GROUP_CHAT_RATE,
+        chat_burst: float = TELEGRAM_CHAT_BURST,
+        max_retries: int = TELEGRAM_MAX_RETRIES,
+        lane_weights: Optional[Dict[str, int]] = None,
+    ):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._private_chat_rate = private_chat_rate
+        self._group_chat_rate = group_chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._chat_buckets: Dict[Union[int, str], TokenBucket] = {}
+        self._lane_weights = dict(lane_weights or TELEGRAM_LANE_WEIGHTS)
+        self._lane_weights.setdefault(PRIORITY_INTERACTIVE, 1)
+        self._lanes: Dict[str, Deque[QueuedRequest]] = {lane: deque() for lane in self._lane_weights}
+        self._lane_credit: Dict[str, int] = {lane: 0 for lane in self._lane_weights}
+        self._in_flight: Set[asyncio.Task] = set()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting to be sent"""
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def lane_depths(self) -> Dict[str, int]:
+        """Number of requests waiting to be sent in each lane"""
+        return {name: len(lane) for name, lane in self._lanes.items()}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests sent and awaiting a response"""
+        return len(self._in_flight)
+
+    async def initialize(self) -> None:
+        """Start the dispatcher"""
+        self._ensure_dispatcher()
+
+    async def shutdown(self) -> None:
+        """Stop the dispatcher and cancel requests that were not sent"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for lane in self._lanes.values():
+            while lane:
+                lane.popleft().future.cancel()
+
+    def _ensure_dispatcher(self):
+        """Start the dispatcher task if it is not running"""
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        """Queue a request and wait for its result"""
+        self._ensure_dispatcher()
+        chat_id = data.get("chat_id") if endpoint.startswith(PER_CHAT_ENDPOINT_PREFIXES) else None
+        lane = (rate_limit_args or {}).get("priority", PRIORITY_INTERACTIVE)
+        if lane not in self._lanes:
+            logger.warning(f"Unknown priority lane {lane} for {endpoint}, using {PRIORITY_INTERACTIVE}")
+            lane = PRIORITY_INTERACTIVE
+        request = QueuedRequest(
+            callback=callback,
+            args=args,
+            kwargs=kwargs,
+            endpoint=endpoint,
+            chat_id=chat_id,
+            future=asyncio.get_running_loop().create_future(),
+            lane=lane,
+        )
+        self._lanes[lane].append(request)
+        self._wakeup.set()
+        return await request.future
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        """Get the token bucket of a chat"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items() if not value.is_full(now)
+                }
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self._group_chat_rate if is_group else self._private_chat_rate
+            bucket = TokenBucket(rate, self._chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _find_ready(self, lane: str, now: float) -> Tuple[Optional[int], float]:
+        """Find the first request in a lane whose chat can be sent to now.
+
+        Returns its position, or None and the seconds until one can be sent."""
+        queue = self._lanes[lane]
+        # Drop requests whose callers gave up waiting
+        while queue and queue[0].future.done():
+            queue.popleft()
+        wait = float("inf")
+        for position, request in enumerate(queue):
+            if request.future.done():
+                continue
+            if request.chat_id is None:
+                return position, 0.0
+            request_wait = self._chat_bucket(request.chat_id).wait_time(now)
+            if request_wait <= 0:
+                return position, 0.0
+            wait = min(wait, request_wait)
+        return None, wait
+
+    def _take_ready(self, now: float) -> Tuple[Optional[QueuedRequest], float]:
+        """Take the next request to send, choosing between lanes by weight.
+
+        Otherwise returns the seconds until one can be sent."""
+        ready = {}
+        wait = float("inf")
+        for lane in self._lanes:
+            position, lane_wait = self._find_ready(lane, now)
+            if position is None:
+                wait = min(wait, lane_wait)
+            else:
+                ready[lane] = position
+        if not ready:
+            return None, wait
+
+        # Smooth weighted round robin over the lanes that can send
+        total_weight = 0
+        for lane in ready:
+            self._lane_credit[lane] += self._lane_weights[lane]
+            total_weight += self._lane_weights[lane]
+        chosen = max(ready, key=lambda lane: self._lane_credit[lane])
+        self._lane_credit[chosen] -= total_weight
+
+        queue = self._lanes[chosen]
+        request = queue[ready[chosen]]
+        del queue[ready[chosen]]
+        return request, 0.0
+
+    async def _dispatch(self):
+        """Send queued requests as fast as the limits allow"""
+        while True:
+            self._wakeup.clear()
+            wait = None
+            if self.queue_depth:
+                now = time.monotonic()
+                wait = max(self._paused_until - now, self._global_bucket.wait_time(now))
+                if wait <= 0:
+                    request, wait = self._take_ready(now)
+                    if request is not None:
+                        self._global_bucket.consume()
+                        if request.chat_id is not None:
+                            self._chat_bucket(request.chat_id).consume()
+                        task = asyncio.create_task(self._send(request))
+                        self._in_flight.add(task)
+                        task.add_done_callback(self._in_flight.discard)
+                        continue
+            try:
+                if wait is None or wait == float("inf"):
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, request: QueuedRequest):
+        """Make a request, re-queuing it if Telegram asks to retry later"""
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            request.attempts += 1
+            if request.attempts > self._max_retries:
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            logger.warning(f"Flood limit hit on {request.endpoint}, pausing requests for {e.retry_after}s "
+                           f"({self.queue_depth} queued)")
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+            self._lanes[request.lane].appendleft(request)
+            self._wakeup.set()
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from telegram.ext import Application, ContextTypes
+
+import config
+from config import ADMIN_IDS, GROUP_IDS
+from utils.entitlements import Entitlements
+from utils.invite_links import InviteLinkRetryQueue
+from utils.json_handler import JsonHandler
+from utils.rate_limiter import PRIORITY_BACKGROUND, priority
+from utils.subscription_manager import RemovalRetryQueue, SubscriptionManager, UnbanScheduler
+
+# Seconds between reconciliation runs, and before the first one after startup
+RECONCILE_INTERVAL = getattr(config, "RECONCILE_INTERVAL", 6 * 60 * 60)
+RECONCILE_FIRST_DELAY = getattr(config, "RECONCILE_FIRST_DELAY", 5 * 60)
+# Corrections queued at once; the rate limiter paces the calls within a batch
+RECONCILE_BATCH_SIZE = getattr(config, "RECONCILE_BATCH_SIZE", 20)
+
+JOB_NAME = "reconcile_memberships"
+# State entry holding the drift metrics of the last run
+METRICS_STATE = "reconciliation"
+
+# Statuses of members who are never removed for lack of a subscription
+EXEMPT_STATUSES = ("administrator", "creator")
+
+logger = logging.getLogger(__name__)
+
+class MembershipReconciler:
+    """Brings group membership back in line with the active subscriptions.
+
+    Members tracked in a group without a subscription that includes it are
+    removed, and subscribers left banned from one of their groups are unbanned
+    and sent a new invite link."""
+    _application: Optional[Application] = None
+    _lock: Optional[asyncio.Lock] = None
+
+    @staticmethod
+    def start(application: Application):
+        """Reconcile periodically in the background of an application"""
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, group membership will not be reconciled.")
+            return
+        MembershipReconciler._application = application
+        application.job_queue.run_repeating(
+            MembershipReconciler._run, interval=RECONCILE_INTERVAL, first=RECONCILE_FIRST_DELAY, name=JOB_NAME
+        )
+
+    @staticmethod
+    async def _run(context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await MembershipReconciler.reconcile()
+        except Exception as e:
+            logger.error(f"Membership reconciliation failed: {e}")
+
+    @staticmethod
+    async def reconcile() -> Dict[str, int]:
+        """Find and correct drift between group membership and subscriptions.
+
+        Returns the drift metrics of the run."""
+        if MembershipReconciler._lock is None:
+            MembershipReconciler._lock = asyncio.Lock()
+        async with MembershipReconciler._lock:
+            # Pick up subscriptions changed outside the bot. The build reads storage
+            # without holding the index lock, so it can run alongside purchases.
+            await JsonHandler.run_async(Entitlements.build)
+
+            metrics = {
+                "tracked_members": 0,
+                "unentitled_members": 0,
+                "removed": 0,
+                "removal_failed": 0,
+                "banned_subscribers": 0,
+                "reinvited": 0,
+            }
+            removals = []
+            reinvites: Dict[int, List[int]] = {}
+            for group_id in GROUP_IDS:
+                memberships = await JsonHandler.aget_group_memberships(group_id)
+                for user_id, membership in memberships.items():
+                    user_id = int(user_id)
+                    entitled = SubscriptionManager.has_group_access(user_id, group_id)
+                    if membership["is_member"]:
+                        metrics["tracked_members"] += 1
+                        if entitled or MembershipReconciler._is_exempt(user_id, membership):
+                            continue
+                        metrics["unentitled_members"] += 1
+                        removals.append((user_id, group_id))
+                    elif entitled and UnbanScheduler.is_banned(membership):
+                        metrics["banned_subscribers"] += 1
+                        reinvites.setdefault(user_id, []).append(group_id)
+
+            for start in range(0, len(removals), RECONCILE_BATCH_SIZE):
+                batch = removals[start:start + RECONCILE_BATCH_SIZE]
+                results = await asyncio.gather(*(
+                    SubscriptionManager.remove_from_group(user_id, group_id) for user_id, group_id in batch
+                ))
+                for (user_id, group_id), result in zip(batch, results):
+                    if result.ok:
+                        metrics["removed"] += 1
+                    else:
+                        metrics["removal_failed"] += 1
+                        logger.warning(f"Reconciliation could not remove user {user_id} from group {group_id}: {result.error}")
+                        await RemovalRetryQueue.add(user_id, group_id, result.error)
+
+            reinvite_items = list(reinvites.items())
+            for start in range(0, len(reinvite_items), RECONCILE_BATCH_SIZE):
+                batch = reinvite_items[start:start + RECONCILE_BATCH_SIZE]
+                reinvited = await asyncio.gather(*(
+                    MembershipReconciler._reinvite(user_id, groups) for user_id, groups in batch
+                ))
+                metrics["reinvited"] += sum(reinvited)
+
+            await JsonHandler.asave_state(METRICS_STATE, {**metrics, "finished_at": int(time.time())})
+            logger.info(f"Membership reconciliation finished: {metrics}")
+            return metrics
+
+    @staticmethod
+    def _is_exempt(user_id: int, membership: Dict) -> bool:
+        """Check if a member may stay in a group without a subscription"""
+        return (
+            user_id in ADMIN_IDS
+            or membership.get("is_bot", False)
+            or membership["status"] in EXEMPT_STATUSES
+        )
+
+    @staticmethod
+    async def _reinvite(user_id: int, groups: List[int]) -> int:
+        """Lift the bans of a subscriber and queue new invite links for them.
+
+        Returns the number of groups the user was queued for."""
+        bot = SubscriptionManager.get_bot()
+        unbanned = []
+        for group_id in groups:
+            try:
+                await bot.unban_chat_member(
+                    chat_id=group_id,
+                    user_id=user_id,
+                    only_if_banned=True,
+                    rate_limit_args=priority(PRIORITY_BACKGROUND)
+                )
+                # Once unbanned, later runs no longer count the user as banned
+                await UnbanScheduler.record_unban(user_id, group_id)
+                unbanned.append(group_id)
+            except Exception as e:
+                logger.warning(f"Reconciliation could not unban user {user_id} in group {group_id}: {e}")
+        if unbanned:
+            await InviteLinkRetryQueue.add(user_id, unbanned)
+            logger.info(f"Queued new invite links for user {user_id} to groups {unbanned}")
+        return len(unbanned)
+
+    @staticmethod
+    async def last_metrics() -> Optional[Dict]:
+        """Get the drift metrics of the last finished run"""
+        return await JsonHandler.aget_state(METRICS_STATE)
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+from functools import lru_cache
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import config
+from config import SUBSCRIPTION_TYPES
+from utils.json_handler import JsonHandler
+
+# Shop credentials from the Robokassa merchant settings. Test mode uses its own
+# pair of passwords, so set the test ones while ROBOKASSA_TEST_MODE is on.
+ROBOKASSA_LOGIN = getattr(config, "ROBOKASSA_LOGIN", None)
+ROBOKASSA_PASSWORD1 = getattr(config, "ROBOKASSA_PASSWORD1", None)
+ROBOKASSA_PASSWORD2 = getattr(config, "ROBOKASSA_PASSWORD2", None)
+ROBOKASSA_TEST_MODE = getattr(config, "ROBOKASSA_TEST_MODE", False)
+# Signature hash algorithm chosen in the merchant settings: md5, sha1, sha256, sha384 or sha512
+ROBOKASSA_HASH_ALGORITHM = getattr(config, "ROBOKASSA_HASH_ALGORITHM", "md5")
+
+# Page the payment links lead to
+ROBOKASSA_PAYMENT_URL = getattr(config, "ROBOKASSA_PAYMENT_URL", "https://auth.robokassa.ru/Merchant/Index.aspx")
+# Receipt fields for fiscalization: tax system (None to use the shop's default) and VAT rate of the plans
+ROBOKASSA_TAX_SYSTEM = getattr(config, "ROBOKASSA_TAX_SYSTEM", None)
+ROBOKASSA_TAX = getattr(config, "ROBOKASSA_TAX", "none")
+# Invoice IDs reserved in storage at a time; IDs left unused at shutdown are skipped
+INVOICE_BLOCK_SIZE = getattr(config, "INVOICE_BLOCK_SIZE", 1000)
+
+# Custom parameters passed through the payment and back to the callbacks
+SHP_USER = "Shp_user"
+SHP_PLAN = "Shp_plan"
+
+INVOICE_STATE = "invoice_ids"
+
+logger = logging.getLogger(__name__)
+
+def is_configured() -> bool:
+    """Check if Robokassa credentials are set"""
+    return bool(ROBOKASSA_LOGIN and ROBOKASSA_PASSWORD1 and ROBOKASSA_PASSWORD2)
+
+def shp_params(params: Mapping[str, str]) -> Dict[str, str]:
+    """Get the custom Shp_ parameters of a request, sorted by name as signatures need them"""
+    return dict(sorted((key, value) for key, value in params.items() if key.lower().startswith("shp_")))
+
+def sign(*parts: str, shp: Mapping[str, str] = None) -> str:
+    """Sign values joined with ':' followed by the Shp_ parameters as name=value"""
+    values = [str(part) for part in parts]
+    values += [f"{key}={value}" for key, value in sorted((shp or {}).items())]
+    return hashlib.new(ROBOKASSA_HASH_ALGORITHM, ":".join(values).encode("utf-8")).hexdigest()
+
+def _matches(expected: str, received: str) -> bool:
+    return hmac.compare_digest(expected.lower(), (received or "").lower())
+
+def verify_result(params: Mapping[str, str]) -> bool:
+    """Check the signature of a ResultURL callback, made with password #2"""
+    expected = sign(params.get("OutSum", ""), params.get("InvId", ""), ROBOKASSA_PASSWORD2, shp=shp_params(params))
+    return _matches(expected, params.get("SignatureValue"))
+
+def verify_success(params: Mapping[str, str]) -> bool:
+    """Check the signature of a SuccessURL redirect, made with password #1"""
+    expected = sign(params.get("OutSum", ""), params.get("InvId", ""), ROBOKASSA_PASSWORD1, shp=shp_params(params))
+    return _matches(expected, params.get("SignatureValue"))
+
+def description(subscription_type: str) -> str:
+    """Describe a plan for the payment page and the receipt"""
+    plan = SUBSCRIPTION_TYPES[subscription_type]
+    return plan.get("description") or f"{subscription_type.title()} subscription, {plan['duration_days']} days"
+
+def out_sum(subscription_type: str) -> str:
+    """Format the price of a plan as Robokassa expects it"""
+    return f"{SUBSCRIPTION_TYPES[subscription_type]['price']:.2f}"
+
+@lru_cache(maxsize=None)
+def receipt(subscription_type: str) -> str:
+    """Get the URL-encoded receipt of a plan, as it is signed and sent"""
+    item = {
+        "name": description(subscription_type)[:128],
+        "quantity": 1,
+        "sum": float(out_sum(subscription_type)),
+        "payment_method": "full_payment",
+        "payment_object": "service",
+        "tax": ROBOKASSA_TAX,
+    }
+    data = {"items": [item]}
+    if ROBOKASSA_TAX_SYSTEM:
+        data["sno"] = ROBOKASSA_TAX_SYSTEM
+    return quote(json.dumps(data, ensure_ascii=False, separators=(",", ":")), safe="")
+
+def payment_url(user_id: int, subscription_type: str, inv_id: int) -> str:
+    """Build a signed link to pay for a plan, signed with password #1"""
+    amount = out_sum(subscription_type)
+    shp = {SHP_PLAN: subscription_type, SHP_USER: str(user_id)}
+    params = {
+        "MerchantLogin": ROBOKASSA_LOGIN,
+        "OutSum": amount,
+        "InvId": inv_id,
+        "Description": description(subscription_type)[:100],
+        "Receipt": receipt(subscription_type),
+        "SignatureValue": sign(
+            ROBOKASSA_LOGIN, amount, inv_id, receipt(subscription_type), ROBOKASSA_PASSWORD1, shp=shp
+        ),
+        **shp,
+    }
+    if ROBOKASSA_TEST_MODE:
+        params["IsTest"] = 1
+    return f"{ROBOKASSA_PAYMENT_URL}?{urlencode(params)}"
+
+class InvoiceIds:
+    """Invoice IDs handed out from blocks reserved in storage.
+
+    Taking an ID needs no storage access: the next block is reserved in the
+    background once the current one is half used, so it is normally ready
+    before it is needed."""
+    _next = 0
+    _end = 0
+    # Block reserved ahead, as (first ID, end)
+    _spare: Optional[Tuple[int, int]] = None
+    _reserving: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _reserve_block() -> Tuple[int, int]:
+        with JsonHandler.transaction():
+            first = JsonHandler.get_state(INVOICE_STATE) or 1
+            JsonHandler.save_state(INVOICE_STATE, first + INVOICE_BLOCK_SIZE)
+        return first, first + INVOICE_BLOCK_SIZE
+
+    @staticmethod
+    async def _reserve_ahead() -> bool:
+        try:
+            InvoiceIds._spare = await JsonHandler.run_async(InvoiceIds._reserve_block)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to reserve invoice IDs: {e}")
+            return False
+        finally:
+            InvoiceIds._reserving = None
+
+    @staticmethod
+    async def reserve() -> bool:
+        """Reserve the next block ahead, unless it is reserved or being reserved.
+
+        Returns False if it could not be reserved."""
+        if InvoiceIds._spare is not None:
+            return True
+        if InvoiceIds._reserving is None:
+            InvoiceIds._reserving = asyncio.create_task(InvoiceIds._reserve_ahead())
+        return await asyncio.shield(InvoiceIds._reserving)
+
+    @staticmethod
+    async def take() -> int:
+        """Get an unused invoice ID"""
+        while InvoiceIds._next >= InvoiceIds._end:
+            if InvoiceIds._spare is None:
+                if not await InvoiceIds.reserve():
+                    raise RuntimeError("No invoice IDs could be reserved")
+                continue
+            InvoiceIds._next, InvoiceIds._end = InvoiceIds._spare
+            InvoiceIds._spare = None
+            logger.info(f"Using invoice IDs {InvoiceIds._next} to {InvoiceIds._end - 1}")
+        inv_id = InvoiceIds._next
+        InvoiceIds._next += 1
+        if InvoiceIds._end - InvoiceIds._next < INVOICE_BLOCK_SIZE // 2 and InvoiceIds._spare is None \
+                and InvoiceIds._reserving is None:
+            InvoiceIds._reserving = asyncio.get_running_loop().create_task(InvoiceIds._reserve_ahead())
+        return inv_id
+
+async def payment_urls(user_id: int) -> Dict[str, str]:
+    """Build a payment link for every plan, keyed by subscription type"""
+    return {
+        subscription_type: payment_url(user_id, subscription_type, await InvoiceIds.take())
+        for subscription_type in SUBSCRIPTION_TYPES
+    }
@@ -0,0 +1,320 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+import config
+from config import DATA_DIR, USERS_FILE, SUBSCRIPTIONS_FILE, GROUPS_FILE
+
+SQLITE_FILE = getattr(config, "SQLITE_FILE", f"{DATA_DIR}/bot.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    subscription_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    subscription_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    type TEXT,
+    start_date INTEGER,
+    end_date INTEGER,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions (user_id);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end_date ON subscriptions (status, end_date);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_end_date ON subscriptions (end_date);
+CREATE TABLE IF NOT EXISTS groups (
+    group_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memberships (
+    group_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (group_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS payments (
+    inv_id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status);
+CREATE TABLE IF NOT EXISTS outbox (
+    entry_id TEXT PRIMARY KEY,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+class SqliteHandler:
+    """SQLite storage with the same interface as JsonHandler"""
+    _connection: Optional[sqlite3.Connection] = None
+    # The connection is shared by the storage threads, one statement at a time
+    _lock = threading.RLock()
+    _local = threading.local()
+
+    @staticmethod
+    def connection() -> sqlite3.Connection:
+        """Get the shared database connection, creating the schema on first use"""
+        with SqliteHandler._lock:
+            if SqliteHandler._connection is None:
+                if not os.path.exists(DATA_DIR):
+                    os.makedirs(DATA_DIR)
+                is_new = not os.path.exists(SQLITE_FILE)
+                conn = sqlite3.connect(SQLITE_FILE, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(SCHEMA)
+                SqliteHandler._connection = conn
+                if is_new:
+                    SqliteHandler.import_json()
+            return SqliteHandler._connection
+
+    @staticmethod
+    def import_json():
+        """Copy existing JSON data files into the database"""
+        for file_path, save in (
+            (USERS_FILE, SqliteHandler.save_user),
+            (SUBSCRIPTIONS_FILE, SqliteHandler.save_subscription),
+            (GROUPS_FILE, SqliteHandler.save_group),
+        ):
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+            for key, record in records.items():
+                save(key, record)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def transaction():
+        """Group storage calls into one database transaction"""
+        if getattr(SqliteHandler._local, "in_transaction", False):
+            yield
+            return
+
+        conn = SqliteHandler.connection()
+        with SqliteHandler._lock:
+            SqliteHandler._local.in_transaction = True
+            try:
+                with conn:
+                    yield
+            finally:
+                SqliteHandler._local.in_transaction = False
+
+    @staticmethod
+    def _execute_write(query: str, params: tuple):
+        """Run a write statement, committing it unless a transaction is open"""
+        conn = SqliteHandler.connection()
+        with SqliteHandler._lock:
+            if getattr(SqliteHandler._local, "in_transaction", False):
+                conn.execute(query, params)
+                return
+            with conn:
+                conn.execute(query, params)
+
+    @staticmethod
+    def _fetch_data(query: str, params: tuple) -> Optional[Dict]:
+        """Fetch a single row and decode its data column"""
+        with SqliteHandler._lock:
+            row = SqliteHandler.connection().execute(query, params).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    @staticmethod
+    def get_user(user_id: int) -> Optional[Dict]:
+        """Get user data"""
+        return SqliteHandler._fetch_data("SELECT data FROM users WHERE user_id = ?", (int(user_id),))
+
+    @staticmethod
+    def save_user(user_id: int, user_data: Dict):
+        """Save user data"""
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO users (user_id, subscription_id, data) VALUES (?, ?, ?)",
+            (int(user_id), user_data.get("subscription_id"), json.dumps(user_data, ensure_ascii=False))
+        )
+
+    @staticmethod
+    def get_all_users() -> Dict[str, Dict]:
+        """Get all users keyed by user ID"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute("SELECT user_id, data FROM users ORDER BY rowid").fetchall()
+        return {str(row["user_id"]): json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_subscription(subscription_id: str) -> Optional[Dict]:
+        """Get subscription data"""
+        return SqliteHandler._fetch_data(
+            "SELECT data FROM subscriptions WHERE subscription_id = ?", (subscription_id,)
+        )
+
+    @staticmethod
+    def save_subscription(subscription_id: str, subscription_data: Dict):
+        """Save subscription data"""
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO subscriptions "
+            "(subscription_id, user_id, type, start_date, end_date, status, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                subscription_id,
+                int(subscription_data["user_id"]),
+                subscription_data.get("type"),
+                subscription_data.get("start_date"),
+                subscription_data.get("end_date"),
+                subscription_data.get("status"),
+                json.dumps(subscription_data, ensure_ascii=False),
+            )
+        )
+
+    @staticmethod
+    def get_all_subscriptions() -> Dict[str, Dict]:
+        """Get all subscriptions keyed by subscription ID"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute(
+                "SELECT subscription_id, data FROM subscriptions ORDER BY rowid"
+            ).fetchall()
+        return {row["subscription_id"]: json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_user_subscriptions(user_id: int) -> Dict[str, Dict]:
+        """Get all subscriptions of a user keyed by subscription ID, oldest first"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute(
+                "SELECT subscription_id, data FROM subscriptions WHERE user_id = ? ORDER BY subscription_id",
+                (int(user_id),)
+            ).fetchall()
+        return {row["subscription_id"]: json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_expiring_subscriptions(start: int, end: int, limit: Optional[int] = None) -> Dict[str, Dict]:
+        """Get up to limit active subscriptions with start <= end_date < end, soonest first"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute(
+                "SELECT subscription_id, data FROM subscriptions "
+                "WHERE status = 'active' AND end_date >= ? AND end_date < ? "
+                "ORDER BY end_date, subscription_id LIMIT ?",
+                (start, end, -1 if limit is None else limit)
+            ).fetchall()
+        return {row["subscription_id"]: json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_next_expiring_subscriptions(limit: int) -> Dict[str, Dict]:
+        """Get up to limit active subscriptions with the earliest end_date, soonest first"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute(
+                "SELECT subscription_id, data FROM subscriptions "
+                "WHERE status = 'active' AND end_date IS NOT NULL "
+                "ORDER BY end_date, subscription_id LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return {row["subscription_id"]: json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_group(group_id: int) -> Optional[Dict]:
+        """Get group data"""
+        return SqliteHandler._fetch_data("SELECT data FROM groups WHERE group_id = ?", (int(group_id),))
+
+    @staticmethod
+    def save_group(group_id: int, group_data: Dict):
+        """Save group data"""
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO groups (group_id, data) VALUES (?, ?)",
+            (int(group_id), json.dumps(group_data, ensure_ascii=False))
+        )
+
+    @staticmethod
+    def get_payment(inv_id: int) -> Optional[Dict]:
+        """Get payment data"""
+        return SqliteHandler._fetch_data("SELECT data FROM payments WHERE inv_id = ?", (int(inv_id),))
+
+    @staticmethod
+    def save_payment(inv_id: int, payment_data: Dict):
+        """Save payment data"""
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO payments (inv_id, user_id, status, data) VALUES (?, ?, ?, ?)",
+            (
+                int(inv_id),
+                payment_data.get("user_id"),
+                payment_data.get("status"),
+                json.dumps(payment_data, ensure_ascii=False),
+            )
+        )
+
+    @staticmethod
+    def get_outbox_entry(entry_id: str) -> Optional[Dict]:
+        """Get outbox entry data"""
+        return SqliteHandler._fetch_data("SELECT data FROM outbox WHERE entry_id = ?", (entry_id,))
+
+    @staticmethod
+    def save_outbox_entry(entry_id: str, entry_data: Dict):
+        """Save outbox entry data"""
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO outbox (entry_id, status, data) VALUES (?, ?, ?)",
+            (entry_id, entry_data.get("status"), json.dumps(entry_data, ensure_ascii=False))
+        )
+
+    @staticmethod
+    def delete_outbox_entry(entry_id: str):
+        """Delete an outbox entry"""
+        SqliteHandler._execute_write("DELETE FROM outbox WHERE entry_id = ?", (entry_id,))
+
+    @staticmethod
+    def get_outbox_entries(status: str) -> Dict[str, Dict]:
+        """Get all outbox entries with a status keyed by entry ID, oldest first"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute(
+                "SELECT entry_id, data FROM outbox WHERE status = ? ORDER BY rowid", (status,)
+            ).fetchall()
+        return {row["entry_id"]: json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_membership(group_id: int, user_id: int) -> Optional[Dict]:
+        """Get the last known membership of a user in a group"""
+        return SqliteHandler._fetch_data(
+            "SELECT data FROM memberships WHERE group_id = ? AND user_id = ?", (int(group_id), int(user_id))
+        )
+
+    @staticmethod
+    def save_membership(group_id: int, user_id: int, membership: Dict):
+        """Save the membership of a user in a group"""
+        membership = {**membership, "group_id": int(group_id), "user_id": int(user_id)}
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO memberships (group_id, user_id, status, data) VALUES (?, ?, ?, ?)",
+            (int(group_id), int(user_id), membership.get("status"), json.dumps(membership, ensure_ascii=False))
+        )
+
+    @staticmethod
+    def get_group_memberships(group_id: int) -> Dict[str, Dict]:
+        """Get the last known memberships of all users seen in a group, keyed by user ID"""
+        with SqliteHandler._lock:
+            rows = SqliteHandler.connection().execute(
+                "SELECT user_id, data FROM memberships WHERE group_id = ?", (int(group_id),)
+            ).fetchall()
+        return {str(row["user_id"]): json.loads(row["data"]) for row in rows}
+
+    @staticmethod
+    def get_state(name: str) -> Any:
+        """Get a stored state value"""
+        with SqliteHandler._lock:
+            row = SqliteHandler.connection().execute("SELECT data FROM state WHERE name = ?", (name,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    @staticmethod
+    def save_state(name: str, value: Any):
+        """Save a state value"""
+        SqliteHandler._execute_write(
+            "INSERT OR REPLACE INTO state (name, data) VALUES (?, ?)",
+            (name, json.dumps(value, ensure_ascii=False))
+        )
@@ -1,19 +1,81 @@
+import asyncio
+import copy
+import random
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from telegram import Bot
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+from telegram.ext import Application, ContextTypes, ExtBot
 import logging
 
+import config
 from config import SUBSCRIPTION_TYPES, BOT_TOKEN
+from utils.entitlements import Entitlements
 from utils.json_handler import JsonHandler
+from utils.rate_limiter import PRIORITY_BACKGROUND, PRIORITY_PAYMENT, TelegramRateLimiter, priority
+from utils.telegram_client import build_request
+
+# Groups a user is removed from at the same time when a subscription expires
+GROUP_REMOVAL_CONCURRENCY = getattr(config, "GROUP_REMOVAL_CONCURRENCY", 5)
+# Failed removals: seconds between checks for due retries, retries run at once,
+# backoff before the first retry (doubled after each failure, up to the maximum)
+# and attempts before a removal is moved to the dead-letter list
+REMOVAL_RETRY_POLL_INTERVAL = getattr(config, "REMOVAL_RETRY_POLL_INTERVAL", 30)
+REMOVAL_RETRY_WORKERS = getattr(config, "REMOVAL_RETRY_WORKERS", 5)
+REMOVAL_RETRY_BASE_DELAY = getattr(config, "REMOVAL_RETRY_BASE_DELAY", 60)
+REMOVAL_RETRY_MAX_DELAY = getattr(config, "REMOVAL_RETRY_MAX_DELAY", 6 * 60 * 60)
+REMOVAL_MAX_ATTEMPTS = getattr(config, "REMOVAL_MAX_ATTEMPTS", 10)
+
+# Seconds a removed user stays banned. Telegram treats bans shorter than 30 seconds
+# as permanent, and the ban may wait in the rate limiter queue before it is sent,
+# so this leaves a wide margin.
+REMOVAL_BAN_SECONDS = max(getattr(config, "REMOVAL_BAN_SECONDS", 5 * 60), 60)
+# Seconds unbans are collected for before they are sent together
+UNBAN_COALESCE_DELAY = getattr(config, "UNBAN_COALESCE_DELAY", 2.0)
+
+REMOVAL_RETRY_JOB_NAME = "retry_group_removals"
+# State entry holding the queued and dead-lettered removals
+REMOVAL_QUEUE_STATE = "removal_queue"
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+@dataclass
+class GroupRemovalResult:
+    """Outcome of removing a user from one group"""
+    group_id: int
+    # "removed", "not_member", "status_unknown" or "failed"
+    status: str
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        """Check if the user is known to be out of the group"""
+        return self.status in ("removed", "not_member")
+
 class SubscriptionManager:
+    # Bot used for group management, normally the application's own bot
+    _bot: Optional[ExtBot] = None
+
+    @staticmethod
+    def set_bot(bot: ExtBot):
+        """Use an already initialized bot for Telegram calls"""
+        SubscriptionManager._bot = bot
+
+    @staticmethod
+    def get_bot() -> ExtBot:
+        """Get the shared bot, creating a pooled, rate limited one if none was set"""
+        if SubscriptionManager._bot is None:
+            SubscriptionManager._bot = ExtBot(
+                token=BOT_TOKEN, request=build_request(), rate_limiter=TelegramRateLimiter()
+            )
+        return SubscriptionManager._bot
+
     @staticmethod
     def create_subscription(user_id: int, subscription_type: str) -> str:
-        """Create a new subscription"""
+        """Create a new subscription.
+
+        It is often part of a larger transaction, so the caller grants the
+        entitlement with Entitlements.grant() once the subscription is committed."""
         if subscription_type not in SUBSCRIPTION_TYPES:
             raise ValueError(f"Invalid subscription type: {subscription_type}")
 
@@ -34,18 +96,19 @@ class SubscriptionManager:
             "status": "active"
         }
 
-        # Save subscription
-        JsonHandler.save_subscription(subscription_id, subscription_data)
+        with JsonHandler.transaction():
+            # Save subscription
+            JsonHandler.save_subscription(subscription_id, subscription_data)
 
-        # Update user data
-        user_data = JsonHandler.get_user(user_id) or {}
-        user_data.update({
-            "subscription_id": subscription_id,
-            "subscription_type": subscription_type,
-            "subscription_start": start_date,
-            "subscription_end": end_date
-        })
-        JsonHandler.save_user(user_id, user_data)
+            # Update user data
+            user_data = JsonHandler.get_user(user_id) or {}
+            user_data.update({
+                "subscription_id": subscription_id,
+                "subscription_type": subscription_type,
+                "subscription_start": start_date,
+                "subscription_end": end_date
+            })
+            JsonHandler.save_user(user_id, user_data)
 
         return subscription_id
 
@@ -64,85 +127,395 @@ class SubscriptionManager:
 
         return subscription
 
+    @staticmethod
+    def get_user_subscriptions(user_id: int) -> Dict[str, Dict]:
+        """Get all of user's subscriptions, active or not, oldest first"""
+        return JsonHandler.get_user_subscriptions(user_id)
+
+    @staticmethod
+    def next_expiring(limit: int) -> Dict[str, Dict]:
+        """Get up to limit active subscriptions that end soonest"""
+        return JsonHandler.get_next_expiring_subscriptions(limit)
+
+    @staticmethod
+    def expiring_between(t0: int, t1: int, limit: Optional[int] = None) -> Dict[str, Dict]:
+        """Get up to limit active subscriptions ending at or after t0 and before t1, soonest first"""
+        return JsonHandler.get_expiring_subscriptions(t0, t1, limit)
+
     @staticmethod
     def is_subscription_active(user_id: int) -> bool:
         """Check if user has active subscription"""
-        subscription = SubscriptionManager.get_user_subscription(user_id)
-        if not subscription:
-            return False
-
-        current_time = int(time.time())
-        return subscription["end_date"] > current_time
+        return Entitlements.is_active(user_id)
 
     @staticmethod
     def get_subscription_groups(user_id: int) -> List[int]:
         """Get list of groups user has access to"""
-        subscription = SubscriptionManager.get_user_subscription(user_id)
-        if not subscription:
-            return []
+        return Entitlements.groups(user_id)
 
-        subscription_type = subscription["type"]
-        return SUBSCRIPTION_TYPES[subscription_type]["groups"]
+    @staticmethod
+    def has_group_access(user_id: int, group_id: int) -> bool:
+        """Check if user's active subscription includes a group"""
+        return Entitlements.has_access(user_id, group_id)
 
     @staticmethod
-    async def expire_subscription(user_id: int):
-        """Mark user's subscription as expired and remove from groups"""
-        user_data = JsonHandler.get_user(user_id)
-        if not user_data or "subscription_id" not in user_data:
-            logger.warning(f"No subscription found for user {user_id}")
-            return
+    def get_group_subscribers(group_id: int) -> Set[int]:
+        """Get the users whose active subscription includes a group"""
+        return Entitlements.members(group_id)
+
+    @staticmethod
+    async def aget_user_subscription(user_id: int) -> Optional[Dict]:
+        """Get user's active subscription without blocking the event loop"""
+        return await JsonHandler.run_async(SubscriptionManager.get_user_subscription, user_id)
+
+    @staticmethod
+    async def aget_user_subscriptions(user_id: int) -> Dict[str, Dict]:
+        """Get all of user's subscriptions without blocking the event loop"""
+        return await JsonHandler.aget_user_subscriptions(user_id)
+
+    @staticmethod
+    async def anext_expiring(limit: int) -> Dict[str, Dict]:
+        """Get the subscriptions that end soonest without blocking the event loop"""
+        return await JsonHandler.aget_next_expiring_subscriptions(limit)
+
+    @staticmethod
+    async def aexpiring_between(t0: int, t1: int, limit: Optional[int] = None) -> Dict[str, Dict]:
+        """Get subscriptions ending in [t0, t1) without blocking the event loop"""
+        return await JsonHandler.aget_expiring_subscriptions(t0, t1, limit)
+
+    @staticmethod
+    async def ais_subscription_active(user_id: int) -> bool:
+        """Check if user has active subscription without blocking the event loop"""
+        if Entitlements.is_built():
+            return SubscriptionManager.is_subscription_active(user_id)
+        return await JsonHandler.run_async(SubscriptionManager.is_subscription_active, user_id)
+
+    @staticmethod
+    async def aget_subscription_groups(user_id: int) -> List[int]:
+        """Get list of groups user has access to without blocking the event loop"""
+        if Entitlements.is_built():
+            return SubscriptionManager.get_subscription_groups(user_id)
+        return await JsonHandler.run_async(SubscriptionManager.get_subscription_groups, user_id)
+
+    @staticmethod
+    async def ahas_group_access(user_id: int, group_id: int) -> bool:
+        """Check if user's active subscription includes a group without blocking the event loop"""
+        if Entitlements.is_built():
+            return SubscriptionManager.has_group_access(user_id, group_id)
+        return await JsonHandler.run_async(SubscriptionManager.has_group_access, user_id, group_id)
+
+    @staticmethod
+    async def remove_from_group(user_id: int, group_id: int) -> GroupRemovalResult:
+        """Remove user from a group"""
+        bot = SubscriptionManager.get_bot()
+        try:
+            logger.info(f"Attempting to remove user {user_id} from group {group_id}")
+            # Check if user is in the group, from tracked chat_member updates if
+            # the bot has seen any for them and by asking Telegram otherwise
+            membership = await JsonHandler.aget_membership(group_id, user_id)
+            if membership is not None:
+                if not membership["is_member"]:
+                    logger.info(f"User {user_id} is already not in group {group_id}")
+                    return GroupRemovalResult(group_id, "not_member")
+            else:
+                try:
+                    member = await bot.get_chat_member(
+                        chat_id=group_id,
+                        user_id=user_id,
+                        rate_limit_args=priority(PRIORITY_BACKGROUND)
+                    )
+                    if member.status in ['left', 'kicked', 'banned']:
+                        logger.info(f"User {user_id} is already not in group {group_id}")
+                        return GroupRemovalResult(group_id, "not_member")
+                except Exception as e:
+                    logger.warning(f"Could not get chat member status for user {user_id} in group {group_id}: {e}")
+                    return GroupRemovalResult(group_id, "status_unknown", str(e))
+
+            # Remove user with a timed ban that lifts itself, so they can rejoin after renewing
+            until_date = int(time.time()) + REMOVAL_BAN_SECONDS
+            try:
+                await bot.ban_chat_member(
+                    chat_id=group_id,
+                    user_id=user_id,
+                    until_date=until_date,
+                    rate_limit_args=priority(PRIORITY_BACKGROUND)
+                )
+            except Exception as e:
+                logger.error(f"Failed to remove user {user_id} from group {group_id}: {e}")
+                return GroupRemovalResult(group_id, "failed", str(e))
+            await UnbanScheduler.record_ban(user_id, group_id, until_date, membership)
+            logger.info(f"Successfully removed user {user_id} from group {group_id}")
+            return GroupRemovalResult(group_id, "removed")
+        except Exception as e:
+            logger.error(f"Error in group removal process for user {user_id} in group {group_id}: {e}")
+            return GroupRemovalResult(group_id, "failed", str(e))
+
+    @staticmethod
+    async def remove_from_groups(user_id: int, groups: List[int]) -> Dict[int, GroupRemovalResult]:
+        """Remove user from several groups concurrently, keyed by group ID"""
+        semaphore = asyncio.Semaphore(GROUP_REMOVAL_CONCURRENCY)
+
+        async def remove(group_id: int) -> GroupRemovalResult:
+            async with semaphore:
+                return await SubscriptionManager.remove_from_group(user_id, group_id)
+
+        results = await asyncio.gather(*(remove(group_id) for group_id in groups))
+        return {result.group_id: result for result in results}
+
+    @staticmethod
+    async def expire_subscription(user_id: int, subscription_id: Optional[str] = None) -> bool:
+        """Mark user's subscription as expired and remove from groups.
+
+        If subscription_id is given and it is not the user's current subscription,
+        it is only marked as expired and the user keeps their group access.
+        Returns True if the user's current subscription was expired."""
+        user_data = await JsonHandler.aget_user(user_id)
+        current_subscription_id = user_data.get("subscription_id") if user_data else None
+        if subscription_id is None:
+            if not current_subscription_id:
+                logger.warning(f"No subscription found for user {user_id}")
+                return False
+            subscription_id = current_subscription_id
+
+        subscription = await JsonHandler.aget_subscription(subscription_id)
+        if subscription and subscription_id != current_subscription_id:
+            subscription["status"] = "expired"
+            await JsonHandler.asave_subscription(subscription_id, subscription)
+            logger.info(f"Marked superseded subscription {subscription_id} as expired for user {user_id}")
+            return False
 
-        subscription_id = user_data["subscription_id"]
-        subscription = JsonHandler.get_subscription(subscription_id)
         if subscription:
+            # Stop granting access right away, e.g. to join requests made during removal
+            Entitlements.revoke(user_id)
+
             # Get groups before marking subscription as expired
             subscription_type = subscription["type"]
             groups = SUBSCRIPTION_TYPES[subscription_type]["groups"]
             logger.info(f"User {user_id} has access to groups: {groups}")
             
             # Remove user from all groups
-            bot = Bot(token=BOT_TOKEN)
-            for group_id in groups:
-                try:
-                    logger.info(f"Attempting to remove user {user_id} from group {group_id}")
-                    # First try to get chat member to check if user is in the group
-                    try:
-                        member = await bot.get_chat_member(chat_id=group_id, user_id=user_id)
-                        if member.status in ['left', 'kicked', 'banned']:
-                            logger.info(f"User {user_id} is already not in group {group_id}")
-                            continue
-                    except Exception as e:
-                        logger.warning(f"Could not get chat member status for user {user_id} in group {group_id}: {e}")
-                        continue
-
-                    # Try to remove user
-                    try:
-                        await bot.ban_chat_member(
-                            chat_id=group_id,
-                            user_id=user_id,
-                            until_date=datetime.now() + timedelta(seconds=35)  # Temporary ban
-                        )
-                        await bot.unban_chat_member(
-                            chat_id=group_id,
-                            user_id=user_id
-                        )
-                        logger.info(f"Successfully removed user {user_id} from group {group_id}")
-                    except Exception as e:
-                        logger.error(f"Failed to remove user {user_id} from group {group_id}: {e}")
-                        # Try alternative method if first method fails
-                        try:
-                            await bot.ban_chat_member(
-                                chat_id=group_id,
-                                user_id=user_id,
-                                until_date=datetime.now() + timedelta(seconds=1)  # Very short ban
-                            )
-                            logger.info(f"Successfully removed user {user_id} from group {group_id} using alternative method")
-                        except Exception as e2:
-                            logger.error(f"Alternative removal method also failed for user {user_id} in group {group_id}: {e2}")
-                except Exception as e:
-                    logger.error(f"Error in group removal process for user {user_id} in group {group_id}: {e}")
+            results = await SubscriptionManager.remove_from_groups(user_id, groups)
+            failed_groups = [group_id for group_id, result in results.items() if not result.ok]
+            if failed_groups:
+                logger.warning(f"User {user_id} may still be in groups {failed_groups}, queuing retries")
+                for group_id in failed_groups:
+                    await RemovalRetryQueue.add(user_id, group_id, results[group_id].error)
 
             # Mark subscription as expired after attempting to remove from groups
             subscription["status"] = "expired"
-            JsonHandler.save_subscription(subscription_id, subscription)
-            logger.info(f"Marked subscription {subscription_id} as expired for user {user_id}") 
\ No newline at end of file
+            await JsonHandler.asave_subscription(subscription_id, subscription)
+            logger.info(f"Marked subscription {subscription_id} as expired for user {user_id}")
+            return True
+        return False 
+
+class RemovalRetryQueue:
+    """Durable queue of group removals that failed, retried with backoff until they succeed.
+
+    Removals that keep failing are moved to a dead-letter list that admins can
+    inspect and re-queue."""
+    _application: Optional[Application] = None
+    # "<group_id>:<user_id>" -> {"user_id", "group_id", "status", "attempts", "next_attempt", "last_error"}
+    # with status "pending" or "dead"
+    _entries: Dict[str, Dict] = {}
+    _lock: Optional[asyncio.Lock] = None
+
+    @staticmethod
+    def start(application: Application):
+        """Load queued removals and start retrying them in the background"""
+        if application.job_queue is None:
+            logger.warning("JobQueue is not available, failed group removals will not be retried.")
+            return
+        RemovalRetryQueue._application = application
+        RemovalRetryQueue._entries = JsonHandler.get_state(REMOVAL_QUEUE_STATE) or {}
+        application.job_queue.run_repeating(
+            RemovalRetryQueue._run, interval=REMOVAL_RETRY_POLL_INTERVAL, first=REMOVAL_RETRY_POLL_INTERVAL,
+            name=REMOVAL_RETRY_JOB_NAME
+        )
+
+    @staticmethod
+    def _backoff(attempts: int) -> float:
+        """Get the seconds to wait before the next attempt, with jitter so retries spread out"""
+        delay = min(REMOVAL_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0), REMOVAL_RETRY_MAX_DELAY)
+        return delay * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    async def _save():
+        # Copied here, as the entries may change while the storage thread writes them
+        await JsonHandler.asave_state(REMOVAL_QUEUE_STATE, copy.deepcopy(RemovalRetryQueue._entries))
+
+    @staticmethod
+    async def add(user_id: int, group_id: int, error: Optional[str] = None):
+        """Queue the removal of a user from a group for retrying"""
+        if RemovalRetryQueue._application is None:
+            return
+        key = f"{group_id}:{user_id}"
+        if key in RemovalRetryQueue._entries:
+            # Already being retried or dead-lettered, keep its backoff
+            RemovalRetryQueue._entries[key]["last_error"] = error
+            return
+        RemovalRetryQueue._entries[key] = {
+            "user_id": user_id,
+            "group_id": group_id,
+            "status": "pending",
+            "attempts": 1,
+            "next_attempt": time.time() + RemovalRetryQueue._backoff(1),
+            "last_error": error,
+        }
+        await RemovalRetryQueue._save()
+
+    @staticmethod
+    def pending() -> List[Dict]:
+        """Get the removals waiting to be retried"""
+        return [entry for entry in RemovalRetryQueue._entries.values() if entry["status"] == "pending"]
+
+    @staticmethod
+    def dead_letters() -> List[Dict]:
+        """Get the removals that were given up on"""
+        return [entry for entry in RemovalRetryQueue._entries.values() if entry["status"] == "dead"]
+
+    @staticmethod
+    async def requeue_dead_letters() -> int:
+        """Retry all dead-lettered removals from scratch. Returns how many were re-queued."""
+        dead = RemovalRetryQueue.dead_letters()
+        for entry in dead:
+            entry.update(status="pending", attempts=0, next_attempt=time.time())
+        if dead:
+            await RemovalRetryQueue._save()
+        return len(dead)
+
+    @staticmethod
+    async def _run(context: ContextTypes.DEFAULT_TYPE):
+        """Retry all due removals with a pool of workers"""
+        if RemovalRetryQueue._lock is None:
+            RemovalRetryQueue._lock = asyncio.Lock()
+        if RemovalRetryQueue._lock.locked():
+            return
+        async with RemovalRetryQueue._lock:
+            now = time.time()
+            due = asyncio.Queue()
+            for key, entry in RemovalRetryQueue._entries.items():
+                if entry["status"] == "pending" and entry["next_attempt"] <= now:
+                    due.put_nowait(key)
+            if due.empty():
+                return
+
+            async def worker():
+                while not due.empty():
+                    await RemovalRetryQueue._retry(due.get_nowait())
+
+            await asyncio.gather(*(worker() for _ in range(min(REMOVAL_RETRY_WORKERS, due.qsize()))))
+            await RemovalRetryQueue._save()
+
+    @staticmethod
+    async def _retry(key: str):
+        """Retry one removal and reschedule, drop or dead-letter it"""
+        entry = RemovalRetryQueue._entries.get(key)
+        if entry is None:
+            return
+        user_id, group_id = entry["user_id"], entry["group_id"]
+        if SubscriptionManager.has_group_access(user_id, group_id):
+            # Renewed in the meantime, so they may stay
+            logger.info(f"Dropping queued removal of user {user_id} from group {group_id}: access renewed")
+            del RemovalRetryQueue._entries[key]
+            return
+
+        result = await SubscriptionManager.remove_from_group(user_id, group_id)
+        if result.ok:
+            logger.info(f"Queued removal of user {user_id} from group {group_id} succeeded ({result.status})")
+            del RemovalRetryQueue._entries[key]
+            return
+
+        entry["attempts"] += 1
+        entry["last_error"] = result.error
+        if entry["attempts"] >= REMOVAL_MAX_ATTEMPTS:
+            entry["status"] = "dead"
+            logger.error(f"Giving up on removing user {user_id} from group {group_id} "
+                         f"after {entry['attempts']} attempts: {result.error}")
+        else:
+            entry["next_attempt"] = time.time() + RemovalRetryQueue._backoff(entry["attempts"])
+
+class UnbanScheduler:
+    """Lifts the timed bans of users who regain access before their ban ends.
+
+    Removals only ban, so most bans simply run out. Unbans that are needed are
+    collected for UNBAN_COALESCE_DELAY seconds and then sent together."""
+    # "<group_id>:<user_id>" -> unix time the bot's ban of the user ends
+    _bans: Dict[str, float] = {}
+    # (user ID, group ID) waiting to be unbanned
+    _pending: Set[tuple] = set()
+    _flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def is_banned(membership: Optional[Dict]) -> bool:
+        """Check if a membership record shows a ban that has not run out yet.
+
+        Telegram sends no update when a timed ban ends, so the status stays
+        "kicked" afterwards. An until_date of 0 means a permanent ban; records
+        saved without one are treated as permanent too."""
+        if membership is None or membership["status"] != "kicked":
+            return False
+        until_date = membership.get("until_date", 0)
+        return until_date == 0 or until_date > time.time()
+
+    @staticmethod
+    async def record_ban(user_id: int, group_id: int, until_date: int, membership: Optional[Dict] = None):
+        """Remember that the bot just banned a user from a group until a unix time"""
+        now = time.time()
+        if len(UnbanScheduler._bans) > 10000:
+            UnbanScheduler._bans = {key: until for key, until in UnbanScheduler._bans.items() if until > now}
+        UnbanScheduler._bans[f"{group_id}:{user_id}"] = until_date
+        membership = dict(membership or {"is_bot": False})
+        membership.update(status="kicked", is_member=False, until_date=until_date, updated_at=int(now))
+        await JsonHandler.asave_membership(group_id, user_id, membership)
+
+    @staticmethod
+    async def record_unban(user_id: int, group_id: int):
+        """Remember that a user's ban from a group was lifted"""
+        UnbanScheduler._bans.pop(f"{group_id}:{user_id}", None)
+        membership = await JsonHandler.aget_membership(group_id, user_id)
+        if membership is not None and membership["status"] == "kicked":
+            membership.pop("until_date", None)
+            membership.update(status="left", updated_at=int(time.time()))
+            await JsonHandler.asave_membership(group_id, user_id, membership)
+
+    @staticmethod
+    async def unban_if_banned(user_id: int, groups: List[int]):
+        """Queue unbans for the groups a user may still be banned from"""
+        now = time.time()
+        for group_id in groups:
+            banned = UnbanScheduler._bans.get(f"{group_id}:{user_id}", 0) > now
+            if not banned:
+                banned = UnbanScheduler.is_banned(await JsonHandler.aget_membership(group_id, user_id))
+            if banned:
+                UnbanScheduler._pending.add((user_id, group_id))
+        if UnbanScheduler._pending and (UnbanScheduler._flush_task is None or UnbanScheduler._flush_task.done()):
+            UnbanScheduler._flush_task = asyncio.get_running_loop().create_task(UnbanScheduler._flush_later())
+
+    @staticmethod
+    async def _flush_later():
+        await asyncio.sleep(UNBAN_COALESCE_DELAY)
+        await UnbanScheduler.flush()
+
+    @staticmethod
+    async def flush():
+        """Send all queued unbans at once through the rate limiter"""
+        pending, UnbanScheduler._pending = UnbanScheduler._pending, set()
+        bot = SubscriptionManager.get_bot()
+
+        async def unban(user_id: int, group_id: int):
+            if not SubscriptionManager.has_group_access(user_id, group_id):
+                return
+            try:
+                await bot.unban_chat_member(
+                    chat_id=group_id,
+                    user_id=user_id,
+                    only_if_banned=True,
+                    rate_limit_args=priority(PRIORITY_PAYMENT)
+                )
+                await UnbanScheduler.record_unban(user_id, group_id)
+                logger.info(f"Lifted ban of renewed user {user_id} in group {group_id}")
+            except Exception as e:
+                logger.error(f"Failed to unban user {user_id} in group {group_id}: {e}")
+
+        if pending:
+            logger.info(f"Sending {len(pending)} unbans")
+            await asyncio.gather(*(unban(user_id, group_id) for user_id, group_id in pending))
@@ -0,0 +1,30 @@
+import httpx
+from telegram.request import HTTPXRequest
+
+import config
+
+# Connections kept open to the Bot API, and for how many idle seconds
+TELEGRAM_POOL_SIZE = getattr(config, "TELEGRAM_POOL_SIZE", 256)
+TELEGRAM_KEEPALIVE_EXPIRY = getattr(config, "TELEGRAM_KEEPALIVE_EXPIRY", 30.0)
+# Seconds a request waits for a free connection before failing
+TELEGRAM_POOL_TIMEOUT = getattr(config, "TELEGRAM_POOL_TIMEOUT", 5.0)
+
+class KeepAliveRequest(HTTPXRequest):
+    """HTTPXRequest that keeps idle pooled connections open for keepalive_expiry seconds"""
+
+    def __init__(self, keepalive_expiry: float, connection_pool_size: int = 1, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=connection_pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = self._build_client()
+
+def build_request() -> KeepAliveRequest:
+    """Build the pooled HTTP client used for Bot API calls"""
+    return KeepAliveRequest(
+        keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+    )